@@ -0,0 +1,449 @@
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import threading
+import time
+
+from mongodb import MongoAPI
+from rate_limiter import AdaptiveRateLimiter
+from reply_api import REPLY_PAGE_SIZE
+from crawler import PostCrawler, CommentCrawler, PostParser, CommentParser, PostYearResolver
+
+
+BENCH_SYMBOL = 'bench'  # post_bench / comment_bench and their checkpoints are dropped before and after every run
+FIRST_POST_ID = 1500000000
+LAST_DATE = date(2025, 1, 20)
+
+# what a recorded fixture directory holds, see 'record_fixtures'
+RECORDED_FILES = {'list': 'list.html', 'post': 'post.html', 'reply': 'reply.json'}
+
+
+def unthrottled_limiter():
+    # the fixture server answers at once, the benchmark measures the crawler and not the politeness delay
+    return AdaptiveRateLimiter(initial_rate=100000, max_rate=100000, jitter=0)
+
+
+class GubaFixtures(object):
+    # deterministic list, post and reply pages in the markup the parsers read;
+    # with 'recorded_dir' the pages saved by 'record_fixtures' are served instead (the same page for every url)
+
+    def __init__(self, symbol: str = BENCH_SYMBOL, pages: int = 20, posts_per_page: int = 80, replies: int = 40,
+                 sub_replies: int = 2, recorded_dir: str = None):
+        """
+        :param pages: 列表页数
+        :param posts_per_page: 每页帖子数（股吧每页 80 条）
+        :param replies: 每个帖子的一级回复数
+        :param sub_replies: 每条一级回复的楼中楼回复数
+        :param recorded_dir: 录制页面的目录（list.html、post.html、reply.json），None 表示使用生成的页面
+        """
+        self.symbol = symbol
+        self.pages = pages
+        self.posts_per_page = posts_per_page
+        self.replies = replies
+        self.sub_replies = sub_replies
+        self.recorded = None
+        if recorded_dir is not None:
+            self.recorded = {}
+            for kind, name in RECORDED_FILES.items():
+                with open(os.path.join(recorded_dir, name), encoding='utf-8') as f:
+                    self.recorded[kind] = json.load(f) if name.endswith('.json') else f.read()
+
+    def post_ids(self, page: int):
+        newest = FIRST_POST_ID + self.pages * self.posts_per_page
+        return [newest - (page - 1) * self.posts_per_page - i for i in range(self.posts_per_page)]
+
+    def post_date(self, post_id):
+        # eight posts a day back from LAST_DATE, so the list pages cross a new year
+        newest = FIRST_POST_ID + self.pages * self.posts_per_page
+        return LAST_DATE - timedelta(days=(newest - post_id) // 8)
+
+    def post_url(self, post_id):
+        return f'/news,{self.symbol},{post_id}.html'
+
+    def list_page(self, page: int):
+        if self.recorded is not None:
+            return self.recorded['list']
+        rows = ''.join(
+            f'<tr class="listitem"><td><div>{post_id % 997}</div></td><td><div>{self.comment_num()}</div></td>'
+            f'<td><div><a href="{self.post_url(post_id)}" title="帖子 {post_id}">帖子 {post_id}</a></div></td>'
+            f'<td><div>作者{post_id % 89}</div></td>'
+            f'<td><div class="update pub_time">{self.post_date(post_id).strftime("%m-%d")} 10:22</div></td></tr>'
+            for post_id in self.post_ids(page))
+        paging = ''.join(f'<li>{i}</li>' for i in range(1, 7)) + f'<li><a><span>{self.pages}</span></a></li>'
+        return (f'<html><head><title>{self.symbol}吧_股吧</title></head><body><ul class="paging">{paging}</ul>'
+                f'<table><tbody>{rows}</tbody></table></body></html>')
+
+    def comment_num(self):
+        return self.replies * (1 + self.sub_replies)
+
+    def reply_time(self, post_id, index: int):
+        return (datetime.combine(self.post_date(post_id), datetime.min.time()) +
+                timedelta(minutes=index)).strftime('%Y-%m-%d %H:%M:%S')
+
+    def post_page(self, post_id):
+        if self.recorded is not None:
+            return self.recorded['post']
+        items = []
+        for index in range(self.replies):
+            subs = ''.join(
+                f'<li class="reply_item_l2"><div class="reply_title"><span>回复 {index}-{sub}</span></div>'
+                f'<span class="pubtime">{self.reply_time(post_id, index + sub + 1)}</span>'
+                f'<span class="likemodule">{sub}</span></li>'
+                for sub in range(self.sub_replies))
+            items.append(
+                f'<div class="reply_item cl"><div class="recont_right fl">'
+                f'<div class="reply_title"><span>评论 {post_id} 第 {index} 楼</span></div>'
+                f'<div class="publishtime"><span class="pubtime">{self.reply_time(post_id, index)}</span></div>'
+                f'<ul class="bottomright"><li></li><li></li><li></li><li><span>{index % 7 or "点赞"}</span></li></ul>'
+                f'<ul class="replyListL2">{subs}</ul></div></div>')
+        return (f'<html><head><title>帖子 {post_id}_{self.symbol}吧_股吧</title></head><body>'
+                f'<div class="newsauthor"><div class="author-info cl">'
+                f'<div class="time">{self.post_date(post_id)} 10:22:00 修改</div></div></div>'
+                f'<div class="allReplyList"><div class="replylist_content">{"".join(items)}</div></div></body></html>')
+
+    def reply_data(self, post_id, page: int, page_size: int = REPLY_PAGE_SIZE):
+        if self.recorded is not None:
+            return self.recorded['reply']
+        replies = []
+        for index in range((page - 1) * page_size, min(page * page_size, self.replies)):
+            replies.append({
+                'reply_text': f'评论 {post_id} 第 {index} 楼 <img src="emot.png" title="[微笑]">',
+                'reply_publish_time': self.reply_time(post_id, index),
+                'reply_like_count': index % 7,
+                'child_replys': [{'reply_text': f'回复 {index}-{sub}',
+                                  'reply_publish_time': self.reply_time(post_id, index + sub + 1),
+                                  'reply_like_count': sub} for sub in range(self.sub_replies)],
+            })
+        return {'re': replies, 'count': self.replies, 'rc': 1}
+
+    def stored_posts(self):
+        # post_info documents of every listed post (without 'post_url'), for the comment benchmarks
+        return [{'_id': post_id, 'comment_num': self.comment_num(), 'post_date': str(self.post_date(post_id))}
+                for page in range(1, self.pages + 1) for post_id in self.post_ids(page)]
+
+
+class FixtureServer(object):
+    # serves the fixtures on 127.0.0.1 like guba does: list pages, post pages and the reply data endpoint
+
+    def __init__(self, fixtures: GubaFixtures, port: int = 0):
+        self.fixtures = fixtures
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def handler(self):
+        fixtures, server = self.fixtures, self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, as the real site
+
+            def do_GET(self):
+                server.count()
+                path = self.path.split('?')[0]
+                post = re.match(r'/news,[^,]+,(\d+)\.html$', path)
+                # ordered by post time (list,bench,f_2.html) or by the last reply (list,bench_2.html)
+                listing = re.match(r'/list,[^,_]+(?:,f_(\d+)|_(\d+))?\.html$', path)
+                if post:
+                    self.reply(fixtures.post_page(int(post.group(1))), 'text/html; charset=utf-8')
+                elif listing:
+                    self.reply(fixtures.list_page(int(listing.group(1) or listing.group(2) or 1)),
+                               'text/html; charset=utf-8')
+                else:
+                    self.reply('', 'text/plain', 404)
+
+            def do_POST(self):
+                server.count()
+                form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8'))
+                param = parse_qs(form.get('param', [''])[0])
+                data = fixtures.reply_data(int(param['postid'][0]), int(param['p'][0]),
+                                           int(param.get('ps', [REPLY_PAGE_SIZE])[0]))
+                self.reply(json.dumps(data, ensure_ascii=False), 'application/json; charset=utf-8')
+
+            def reply(self, text, content_type, status=200):
+                body = text.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def reply_api_url(self):
+        return f'{self.url}/api/getData'
+
+
+def record_fixtures(symbol: str, recorded_dir: str):
+    # saves one real list page, the first post on it and its first reply page for later offline runs
+    from fetcher import HttpFetcher
+    from reply_api import ReplyApiClient
+    fetcher = HttpFetcher()
+    os.makedirs(recorded_dir, exist_ok=True)
+    list_source = fetcher.get(f'https://guba.eastmoney.com/list,{symbol}.html')
+    post_path = re.search(r'href="(/news,[^"]+\.html)"', list_source).group(1)
+    post_url = f'https://guba.eastmoney.com{post_path}'
+    post_id = int(re.search(r',(\d+)\.html', post_path).group(1))
+    pages = {'list': list_source, 'post': fetcher.get(post_url),
+             'reply': ReplyApiClient(fetcher).fetch_page(post_id, 1, referer=post_url)}
+    for kind, name in RECORDED_FILES.items():
+        with open(os.path.join(recorded_dir, name), 'w', encoding='utf-8') as f:
+            if name.endswith('.json'):
+                json.dump(pages[kind], f, ensure_ascii=False)
+            else:
+                f.write(pages[kind])
+    print(f'已录制 {symbol} 的列表页、帖子页和回复数据到 {recorded_dir}')
+
+
+def result(name, seconds, pages, rows, **extra):
+    return dict(name=name, seconds=seconds, pages=pages, rows=rows,
+                pages_per_second=pages / seconds if seconds else 0.0,
+                rows_per_second=rows / seconds if seconds else 0.0, **extra)
+
+
+class Benchmark(object):
+    # rows/s of the parsers and pages/s of the crawlers against the fixture server, written as one json report
+
+    def __init__(self, fixtures: GubaFixtures, repeat: int = 5, concurrency: int = 4, browser: bool = False,
+                 playwright: bool = False):
+        """
+        :param repeat: 解析器基准重复的次数，报告取中位数
+        :param concurrency: PostCrawler 的并发页数和 CommentCrawler 的并发回复页数
+        :param browser: 同时测试 selenium 浏览器方式（需要 Chrome）
+        :param playwright: 同时测试 main.py 的 EastMoneyCrawler（需要 playwright 浏览器和 apify）
+        """
+        self.fixtures = fixtures
+        self.repeat = repeat
+        self.concurrency = concurrency
+        self.browser = browser
+        self.playwright = playwright
+        self.server = None
+        self.results = []
+
+    def timed(self, function):
+        # median of 'repeat' runs, after one warm-up run
+        function()
+        durations = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - start)
+        return statistics.median(durations)
+
+    def bench_post_parser(self):
+        pages = [(self.fixtures.list_page(page), page == 1) for page in range(1, self.fixtures.pages + 1)]
+        resolver = PostYearResolver()
+        newest = self.fixtures.post_ids(1)[0]
+        resolver.add_anchor(newest, str(self.fixtures.post_date(newest)))  # as the crawlers do with stored posts
+        parser = PostParser(resolver)
+        rows = sum(len(parser.parse_post_page(source, self.server.url, skip_first=first)) for source, first in pages)
+        seconds = self.timed(lambda: [parser.parse_post_page(source, self.server.url, skip_first=first)
+                                      for source, first in pages])
+        return result('post_parser', seconds, len(pages), rows)
+
+    def bench_comment_parser(self):
+        post_ids = self.fixtures.post_ids(1)[:20]
+        parser = CommentParser()
+        sources = [(self.fixtures.post_page(post_id), post_id) for post_id in post_ids]
+        rows = sum(len(parser.parse_comment_page(source, post_id)) for source, post_id in sources)
+        seconds = self.timed(lambda: [parser.parse_comment_page(source, post_id) for source, post_id in sources])
+        return result('comment_parser_page', seconds, len(sources), rows)
+
+    def bench_reply_parser(self):
+        post_ids = self.fixtures.post_ids(1)[:20]
+        parser = CommentParser()
+        data = [(self.fixtures.reply_data(post_id, 1), post_id) for post_id in post_ids]
+        rows = sum(len(parser.parse_reply_data(page, post_id)) for page, post_id in data)
+        seconds = self.timed(lambda: [parser.parse_reply_data(page, post_id) for page, post_id in data])
+        return result('comment_parser_reply_api', seconds, len(data), rows)
+
+    @staticmethod
+    def drop_collections():
+        for db_name, prefix in (('post_info', 'post'), ('comment_info', 'comment')):
+            MongoAPI(db_name, f'{prefix}_{BENCH_SYMBOL}').collection.drop()
+        # an interrupted or failed run leaves its CrawlCheckpoint ('post_bench_1_20', 'comment_bench_id_...')
+        MongoAPI('crawl_state', 'checkpoint').collection.delete_many(
+            {'_id': {'$regex': f'^(post|comment|incremental)_{BENCH_SYMBOL}(_|$)'}})
+        MongoAPI.ensured.clear()  # the dropped collections need their indexes again
+
+    def bench_post_crawler(self, backend: str, concurrency: int = 1):
+        self.drop_collections()
+        crawler = PostCrawler(BENCH_SYMBOL, backend=backend, base_url=self.server.url, limiter=unthrottled_limiter())
+        requests = self.server.requests
+        start = time.perf_counter()
+        crawler.crawl_post_info(1, self.fixtures.pages, concurrency=concurrency, resume=False)
+        seconds = time.perf_counter() - start
+        return result(f'post_crawler_{backend}_x{concurrency}', seconds, self.fixtures.pages, crawler.row_count,
+                      requests=self.server.requests - requests)
+
+    def seed_posts(self, limit: int):
+        self.drop_collections()
+        posts = self.fixtures.stored_posts()[:limit]
+        for post in posts:
+            post['post_url'] = f"{self.server.url}{self.fixtures.post_url(post['_id'])}"
+        MongoAPI('post_info', f'post_{BENCH_SYMBOL}').bulk_upsert(posts)
+        return posts
+
+    def bench_comment_crawler(self, backend: str, posts: int = 100):
+        seeded = self.seed_posts(posts)
+        crawler = CommentCrawler(BENCH_SYMBOL, backend=backend, reply_api_url=self.server.reply_api_url,
+                                 reply_concurrency=self.concurrency, limiter=unthrottled_limiter())
+        crawler.find_by_id(seeded[-1]['_id'], seeded[0]['_id'], resume=False)
+        requests = self.server.requests
+        start = time.perf_counter()
+        crawler.crawl_comment_info()
+        seconds = time.perf_counter() - start
+        return result(f'comment_crawler_{backend}', seconds, crawler.current_num, crawler.row_count,
+                      requests=self.server.requests - requests)
+
+    def bench_playwright(self, posts: int = 20):
+        import asyncio
+        from playwright.async_api import async_playwright
+        from main import EastMoneyCrawler
+        from dataset_writer import DatasetWriter
+
+        async def push(batch):  # the dataset is not what is measured
+            pass
+
+        async def run():
+            output = DatasetWriter(push, batch_size=50)
+            crawler = EastMoneyCrawler(BENCH_SYMBOL, BENCH_SYMBOL, output, max_posts=posts,
+                                       limiter=unthrottled_limiter(), ready_timeout=5, guba_url=self.server.url)
+            async with async_playwright() as playwright:
+                browser = await playwright.chromium.launch(headless=True)
+                page = await browser.new_page()
+                start = time.perf_counter()
+                async with output:
+                    await crawler.crawl_post_list(page)
+                    for post_url in crawler.post_urls:
+                        await crawler.crawl_comments(page, post_url)
+                seconds = time.perf_counter() - start
+                await browser.close()
+            return result('playwright_crawler', seconds, 1 + len(crawler.post_urls),
+                          crawler.post_count + crawler.comment_count)
+
+        return asyncio.run(run())
+
+    def run(self):
+        self.server = FixtureServer(self.fixtures).start()
+        benches = [
+            ('post_parser', self.bench_post_parser),
+            ('comment_parser_page', self.bench_comment_parser),
+            ('comment_parser_reply_api', self.bench_reply_parser),
+            ('post_crawler_http_x1', lambda: self.bench_post_crawler('http')),
+            (f'post_crawler_http_x{self.concurrency}', lambda: self.bench_post_crawler('http', self.concurrency)),
+            ('comment_crawler_api', lambda: self.bench_comment_crawler('api')),
+        ]
+        if self.browser:
+            benches += [('post_crawler_browser_x1', lambda: self.bench_post_crawler('browser')),
+                        ('comment_crawler_browser', lambda: self.bench_comment_crawler('browser', posts=20))]
+        if self.playwright:
+            benches.append(('playwright_crawler', self.bench_playwright))
+        try:
+            for name, bench in benches:
+                try:
+                    self.results.append(bench())
+                except Exception as e:  # e.g. no mongod, Chrome or playwright here, the other benchmarks still run
+                    print(f'基准 {name} 失败 {e!r}')
+                    self.results.append({'name': name, 'error': repr(e)})
+        finally:
+            self.server.stop()
+            try:
+                self.drop_collections()
+            except Exception:
+                pass
+        return self.results
+
+    def report(self):
+        return {
+            'timestamp': datetime.now().isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {'pages': self.fixtures.pages, 'posts_per_page': self.fixtures.posts_per_page,
+                       'replies': self.fixtures.replies, 'sub_replies': self.fixtures.sub_replies,
+                       'recorded': self.fixtures.recorded is not None, 'repeat': self.repeat,
+                       'concurrency': self.concurrency},
+            'results': self.results,
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(report, baseline):
+    # rows/s of every benchmark relative to an earlier report, > 1 is faster
+    before = {item['name']: item for item in baseline['results'] if 'error' not in item}
+    lines = []
+    for item in report['results']:
+        old = before.get(item['name'])
+        if 'error' in item or old is None or not old['rows_per_second']:
+            continue
+        lines.append(f"{item['name']}: {old['rows_per_second']:.0f} -> {item['rows_per_second']:.0f} 条/秒 "
+                     f"（{item['rows_per_second'] / old['rows_per_second']:.2f}x）")
+    return lines
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='离线基准测试：本地服务器提供录制或生成的股吧页面')
+    arg_parser.add_argument('--pages', type=int, default=20, help='列表页数')
+    arg_parser.add_argument('--replies', type=int, default=40, help='每个帖子的一级回复数')
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    arg_parser.add_argument('--concurrency', type=int, default=4)
+    arg_parser.add_argument('--browser', action='store_true', help='同时测试 selenium 浏览器方式')
+    arg_parser.add_argument('--playwright', action='store_true', help='同时测试 EastMoneyCrawler')
+    arg_parser.add_argument('--fixtures', default=None, help='录制页面的目录，默认使用生成的页面')
+    arg_parser.add_argument('--record', metavar='SYMBOL', default=None, help='从股吧录制页面到 --fixtures 后退出')
+    arg_parser.add_argument('--output', default=None, help='报告路径，默认 benchmarks/bench_{时间}.json')
+    arg_parser.add_argument('--compare', default=None, help='与之前的报告比较')
+    args = arg_parser.parse_args()
+
+    if args.record is not None:
+        record_fixtures(args.record, args.fixtures or 'fixtures')
+    else:
+        benchmark = Benchmark(GubaFixtures(pages=args.pages, replies=args.replies, recorded_dir=args.fixtures),
+                              args.repeat, args.concurrency, args.browser, args.playwright)
+        benchmark.run()
+        report = benchmark.report()
+        output = args.output or os.path.join('benchmarks', f'bench_{datetime.now():%Y%m%d_%H%M%S}.json')
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        for item in report['results']:
+            if 'error' in item:
+                print(f"{item['name']}: 失败 {item['error']}")
+            else:
+                print(f"{item['name']}: {item['pages_per_second']:.1f} 页/秒，{item['rows_per_second']:.0f} 条/秒")
+        if args.compare is not None:
+            with open(args.compare, encoding='utf-8') as f:
+                for line in compare(report, json.load(f)):
+                    print(line)
+        print(f'报告已写入 {output}')
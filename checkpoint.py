@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from mongodb import MongoAPI
+
+
+class CrawlCheckpoint(object):
+    # the frontier of one crawl task, saved after every finished page/post so a restarted crawl continues from it
+
+    def __init__(self, key: str, host='localhost', port=27017):
+        """
+        :param key: 'post_000002_1_600' 或 'comment_000002_date_2024-01-01_2024-12-31'
+        """
+        self.key = key
+        self.statedb = MongoAPI('crawl_state', 'checkpoint', host, port)
+
+    def load(self):
+        return self.statedb.find_one({'_id': self.key}, {'_id': 0})
+
+    def save(self, **state):
+        state['updated_at'] = datetime.now()
+        self.statedb.upsert_one({'_id': self.key}, state)
+
+    def clear(self):  # the task is finished, a new run of it starts from scratch
+        self.statedb.delete_one({'_id': self.key})
@@ -1,15 +1,24 @@
-from selenium import webdriver
 from selenium.webdriver.common.by import By
 import time
-import random
-import pandas as pd
-import os
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+import functools
 from selenium.common.exceptions import TimeoutException
 
-from mongodb import MongoAPI
+from mongodb import MongoAPI, BufferedMongoSink, SinkError
+from fetcher import HttpFetcher
+from checkpoint import CrawlCheckpoint
+from driver_pool import DriverPool
+from rate_limiter import AdaptiveRateLimiter, LIMITER, expected_title
+from readiness import ReadinessWaiter
+from reply_api import ReplyApiClient, REPLY_API_URL
+from seen_filter import SeenPosts
+from metrics import METRICS
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from itertools import islice
 import importlib.util
+import json
+import math
 import sys
 import os
 
@@ -21,188 +30,762 @@ spec.loader.exec_module(local_parser)
 
 PostParser = local_parser.PostParser
 CommentParser = local_parser.CommentParser
+PostYearResolver = local_parser.PostYearResolver
+COMMENT_ROW = local_parser.COMMENT_SELECTORS['row'].css  # the comments are rendered by javascript after the load
+
+GUBA_URL = 'http://guba.eastmoney.com'
 
 
 class PostCrawler(object):
 
-    def __init__(self, stock_symbol: str):
+    def __init__(self, stock_symbol: str, backend: str = 'browser', base_url: str = GUBA_URL,
+                 driver_pool: DriverPool = None, limiter: AdaptiveRateLimiter = LIMITER, seen_dir: str = None,
+                 list_order: str = 'post'):
+        """
+        :param backend: 'browser' 全部用 selenium 打开; 'http' 先用 HTTP 请求列表页，校验失败时才回退到浏览器
+        :param base_url: 股吧地址，可以指向本地录制页面的服务器
+        :param driver_pool: 共享的预热浏览器池，默认由爬虫自己创建并在结束时关闭
+        :param limiter: 按域名自适应的限速器，默认整个进程共用一个
+        :param seen_dir: 已入库帖子 filter 文件的目录，推断年份时已入库的帖子不再打开；None 表示不使用
+        :param list_order: 'post' 按发帖时间排列的列表页（list,代码,f_页.html，增量爬取依赖这一顺序）;
+                           'reply' 按最后回复时间排列的列表页（list,代码_页.html），仍有新回复的旧帖也在前几页
+        """
         self.browser = None
         self.symbol = stock_symbol
+        self.base_url = base_url
+        self.list_order = list_order
+        self.fetcher = HttpFetcher() if backend == 'http' else None
+        self.labels = {'symbol': stock_symbol, 'backend': backend}  # of the metrics
+        self.limiter = limiter
+        self.own_pool = driver_pool is None
+        self.driver_pool = driver_pool or DriverPool()
+        self.seen = self.open_seen_posts(seen_dir) if seen_dir else None
         self.start = time.time()  # calculate the time cost
+        self.row_count = 0  # posts inserted by this crawler
+
+    def open_seen_posts(self, seen_dir):
+        postdb = MongoAPI('post_info', f'post_{self.symbol}')
+
+        def stored_date(post_id):  # the exact check of a filter hit, also gives the date we need
+            post = postdb.find_one({'_id': post_id, 'post_date': {'$ne': None}}, {'post_date': 1})
+            return post['post_date'] if post else None
+        return SeenPosts(os.path.join(seen_dir, f'posts_{self.symbol}.bloom'), stored_date)
+
+    def remember_posts(self, dic_list):
+        if self.seen is not None:
+            for dic in dic_list:
+                self.seen.add(dic['_id'])
+
+    def save_seen(self):
+        if self.seen is not None:
+            self.seen.save()
+            print(f'{self.symbol}: 已入库帖子 filter 命中 {self.seen.hits} 次，误判 {self.seen.false_positives} 次')
 
     def create_webdriver(self):
-        options = webdriver.ChromeOptions()  # configure the webdriver
-        options.add_argument('lang=zh_CN.UTF-8')
-        options.add_argument('user-agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, '
-                             'like Gecko) Chrome/111.0.0.0 Safari/537.36"')
-        self.browser = webdriver.Chrome(options=options)
-
-        current_dir = os.path.dirname(os.path.abspath(__file__))  # hide the features of crawler/selenium
-        js_file_path = os.path.join(current_dir, 'stealth.min.js')
-        with open(js_file_path) as f:
-            js = f.read()
-        self.browser.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {
-            "source": js
-        })
+        self.browser = self.driver_pool.acquire()  # a warmed session if there is one
+
+    def ensure_webdriver(self):
+        if self.browser is None:  # the http backend only starts chrome when a page fails validation
+            self.create_webdriver()
+
+    def quit_webdriver(self):
+        if self.browser is not None:
+            self.driver_pool.release(self.browser)
+            self.browser = None
+        if self.own_pool:
+            self.driver_pool.close()  # also quit the warmed spares
+        if self.fetcher is not None:
+            self.fetcher.close()
+
+    @staticmethod
+    def print_sink_stats(sink):
+        stats = sink.stats()
+        print(f"共写入数据库 {stats['flushes']} 次 {stats['documents']} 条，平均每次 {stats['avg_flush_seconds']:.3f} 秒，"
+              f"最长 {stats['max_flush_seconds']:.3f} 秒")
+
+    def restart_webdriver(self):
+        if self.browser is None:  # the http backend may not have started chrome at all
+            return
+        METRICS.inc('guba_browser_restarts_total', **self.labels)
+        with METRICS.timer('browser_restart', **self.labels):
+            try:
+                self.browser.delete_all_cookies()
+            except Exception:  # the session itself is broken
+                self.browser = self.driver_pool.replace(self.browser)
+                return
+            # only swapped for a warmed spare once its recent error rate shows we are restricted
+            self.browser = self.driver_pool.report(self.browser, ok=False)
+
+    def list_url(self, page: int):
+        if self.list_order == 'reply':  # guba's default list, the thread with the latest reply first
+            suffix = f'_{page}' if page > 1 else ''
+            return f'{self.base_url}/list,{self.symbol}{suffix}.html'
+        return f'{self.base_url}/list,{self.symbol},f_{page}.html'
+
+    def is_post_url(self, url):
+        # other website (e.g. caifuhao) is different!
+        parsed, base = urlparse(url), urlparse(self.base_url)
+        return parsed.netloc == base.netloc and parsed.path.startswith('/news')
 
     def get_page_num(self):
-        self.browser.get(f'http://guba.eastmoney.com/list,{self.symbol},f_1.html')
+        url = self.list_url(1)
+        if self.fetcher is not None:
+            try:
+                return PostParser.parse_page_num(self.fetcher.get(url))
+            except Exception as e:  # the paging may not be server-rendered
+                print(f'{self.symbol}: HTTP 获取总页数失败 {e}，改用浏览器')
+        self.ensure_webdriver()
+        self.browser.get(url)
         page_element = self.browser.find_element(By.CSS_SELECTOR, 'ul.paging > li:nth-child(7) > a > span')
         return int(page_element.text)
 
-    def crawl_post_info(self, page1: int, page2: int):
-        self.create_webdriver()
-        max_page = self.get_page_num()  # confirm the maximum page number to crawl
+    def new_post_parser(self):
+        # the year of a post comes from known post dates, or from its own page through our session/browser
+        return PostParser(PostYearResolver(self.fetcher, lambda: self.browser, seen=self.seen))
+
+    def fetch_http_page(self, parser, url, first_page: bool):
+        self.limiter.wait(url)
+        try:
+            with METRICS.timer('navigation', symbol=self.symbol, backend='http'):
+                page_source = self.fetcher.get(url)
+            with METRICS.timer('parse', symbol=self.symbol, backend='http'):
+                dic_list = parser.parse_post_page(page_source, url, skip_first=first_page)
+        except Exception:  # timeouts and refused requests
+            self.limiter.throttled(url, 'error')
+            raise
+        if not dic_list:  # a page without any '.listitem' means we are restricted, ask the browser
+            self.limiter.throttled(url, 'empty')
+            raise ValueError('HTTP 页面未找到帖子')
+        self.limiter.success(url)
+        return dic_list
+
+    def fetch_post_page(self, parser, url, first_page: bool, prefetched=None):
+        if prefetched:  # already fetched and parsed by the concurrent mode
+            return prefetched
+        if self.fetcher is not None:
+            try:
+                return self.fetch_http_page(parser, url, first_page)
+            except Exception as e:
+                print(f'{self.symbol}: HTTP 请求失败 {e}，改用浏览器 （{url}）')
+
+        self.ensure_webdriver()
+        self.limiter.wait(url)
+        try:
+            with METRICS.timer('navigation', symbol=self.symbol, backend='browser'):
+                self.browser.get(url)  # many times our crawler is restricted access (especially after 664 pages)
+            with METRICS.timer('parse', symbol=self.symbol, backend='browser'):
+                dic_list = self.parse_post_page(parser, url, first_page)
+        except Exception:
+            self.limiter.throttled(url, 'error')
+            raise
+        if not dic_list:  # a restricted or half-loaded page, retried after the restart like any other error
+            self.limiter.throttled(url, 'empty')
+            raise ValueError('页面未找到帖子')
+        self.limiter.success(url)
+        if self.fetcher is not None:
+            self.fetcher.load_browser_cookies(self.browser)  # keep the http session as the browser visitor
+        self.browser = self.driver_pool.report(self.browser, ok=True)
+        return dic_list
+
+    def parse_post_page(self, parser, url, first_page: bool):
+        try:  # one page_source snapshot instead of a WebDriver round trip for every field
+            return parser.parse_post_page(self.browser.page_source, url, skip_first=first_page)
+        except Exception as e:  # fall back to the WebDriver elements if the snapshot can not be parsed
+            print(f'{self.symbol}: 页面快照解析失败 {e}，改用逐元素解析')
+            list_item = self.browser.find_elements(By.CSS_SELECTOR, '.listitem')  # includes all posts on one page
+            if first_page:
+                list_item = list_item[1:]  # 剔除首页的置顶帖（开户广告hhh）
+            return [parser.parse_post_info(li) for li in list_item]
+
+    @staticmethod
+    def take_prefetched(prefetched, page: int):
+        future = prefetched.pop(page, None)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:  # 'fetch_post_page' will retry it and fall back to the browser
+            print(f'第 {page} 页预取失败 {e}')
+            return None
+
+    def crawl_post_info(self, page1: int, page2: int, concurrency: int = 1, resume: bool = True):
+        """
+        :param concurrency: 同时在途的列表页数量，大于 1 时用 HTTP 并发抓取和解析，入库仍按页码顺序进行；
+                            'browser' 方式也会因此改为先用 HTTP 请求、失败时才用浏览器，指标标签随之记为 'http'
+        :param resume: 从上次中断的页码继续（断点保存在 crawl_state.checkpoint，整个范围爬完后清除）
+        """
+        if concurrency > 1 and self.fetcher is None:  # the browser backend becomes the http one
+            print(f'{self.symbol}: 并发爬取列表页使用 HTTP 请求，浏览器只在请求失败时使用')
+            self.fetcher = HttpFetcher(pool_size=concurrency)
+            self.labels['backend'] = 'http'
         current_page = page1  # start page
-        stop_page = min(page2, max_page)  # avoid out of the index
 
-        parser = PostParser()  # must be created out of the 'while', as it contains the function about date
+        parser = self.new_post_parser()  # shared by every page, it caches the resolved years
         postdb = MongoAPI('post_info', f'post_{self.symbol}')  # connect the collection
 
-        while current_page <= stop_page:  # use 'while' instead of 'for' is crucial for exception handling
-            time.sleep(abs(random.normalvariate(0, 0.01)))  # random sleep time
-            url = f'http://guba.eastmoney.com/list,{self.symbol},f_{current_page}.html'
-
-            try:
-                self.browser.get(url)  # many times our crawler is restricted access (especially after 664 pages)
-                dic_list = []
-                list_item = self.browser.find_elements(By.CSS_SELECTOR, '.listitem')  # includes all posts on one page
-                if current_page == 1:
-                    list_item = list_item[1:]  # 剔除首页的置顶帖（开户广告hhh）
-                for li in list_item:  # get each post respectively
-                    dic = parser.parse_post_info(li)
-                    if 'guba.eastmoney.com/news' in dic['post_url']:  # other website is different!
-                        dic_list.append(dic)
-                postdb.insert_many(dic_list)
-                print(f'{self.symbol}: 已经成功爬取第 {current_page} 页帖子基本信息，'
-                      f'进度 {(current_page - page1 + 1)*100/(stop_page - page1 + 1):.2f}%')
-                current_page += 1
-
-            except Exception as e:
-                print(f'{self.symbol}: 第 {current_page} 页出现了错误 {e}')
-                time.sleep(0.01)
-                self.browser.refresh()
-                self.browser.delete_all_cookies()
-                self.browser.quit()  # if we don't restart the webdriver, our crawler will be restricted access speed
-                self.create_webdriver()  # restart it again!
+        order = '' if self.list_order == 'post' else f'_{self.list_order}'  # the pages hold other posts
+        checkpoint = CrawlCheckpoint(f'post_{self.symbol}_{page1}_{page2}{order}')
+        state = checkpoint.load() if resume else None
+        if state is not None:
+            current_page = state['page'] + 1
+            print(f'{self.symbol}: 从断点第 {current_page} 页继续爬取')
+        pool = ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+        prefetched = {}  # page -> future of the parsed page, stored in page order to keep the checkpoint right
+        next_page = current_page
+
+        sink = BufferedMongoSink(postdb, labels=self.labels)  # mongo writes run behind the fetching and parsing
+        try:
+            if self.fetcher is None:
+                self.create_webdriver()
+            max_page = self.get_page_num()  # confirm the maximum page number to crawl
+            stop_page = min(page2, max_page)  # avoid out of the index
+            while current_page <= stop_page:  # use 'while' instead of 'for' is crucial for exception handling
+                if pool is not None:
+                    while next_page <= stop_page and next_page < current_page + concurrency:  # keep N pages in flight
+                        prefetched[next_page] = pool.submit(self.fetch_http_page, parser, self.list_url(next_page),
+                                                            next_page == 1)
+                        next_page += 1
+                url = self.list_url(current_page)
+
+                try:
+                    dic_list = []
+                    posts = self.take_prefetched(prefetched, current_page)
+                    for dic in self.fetch_post_page(parser, url, current_page == 1, posts):  # get each post respectively
+                        if self.is_post_url(dic['post_url']):  # other website is different!
+                            dic_list.append(dic)
+                    # keyed on the guba post id, a re-crawled page just updates; the checkpoint follows the write
+                    sink.put_many(dic_list, on_flushed=functools.partial(checkpoint.save, page=current_page))
+                    self.remember_posts(dic_list)
+                    self.row_count += len(dic_list)
+                    METRICS.inc('guba_pages_total', kind='post_list', status='ok', **self.labels)
+                    METRICS.inc('guba_rows_total', len(dic_list), kind='post', **self.labels)
+                    print(f'{self.symbol}: 已经成功爬取第 {current_page} 页帖子基本信息，'
+                          f'进度 {(current_page - page1 + 1)*100/(stop_page - page1 + 1):.2f}%，'
+                          f'当前速率 {self.limiter.rate(url):.2f} 页/秒')
+                    current_page += 1
+
+                except SinkError:  # retrying the page can not help, every later write would be dropped too
+                    raise
+                except Exception as e:
+                    print(f'{self.symbol}: 第 {current_page} 页出现了错误 {e}')
+                    METRICS.inc('guba_retries_total', kind='post_list', **self.labels)
+                    time.sleep(0.01)
+                    self.restart_webdriver()
+        finally:
+            if pool is not None:  # an interrupted crawl drops the pages still waiting for a worker
+                pool.shutdown(cancel_futures=True)
+            self.quit_webdriver()  # a failed task must not leave chrome running in the scheduler's worker
+            sink.close()  # also flushes the finished pages when the crawl is interrupted
+            self.save_seen()
+
+        checkpoint.clear()  # the whole range is finished
 
         end = time.time()
         time_cost = end - self.start  # calculate the time cost
-        start_date = postdb.find_last()['post_date']
-        end_date = postdb.find_first()['post_date']  # get the post time range
+        start_date = postdb.find_first()['post_date']  # guba post ids increase with the post time
+        end_date = postdb.find_last()['post_date']  # get the post time range
         # end_date = mongodb.find_one({}, {'_id': 0, 'post_date': 1})['post_date']  # first post is hottest not newest
         row_count = postdb.count_documents()
-        self.browser.quit()
+        self.print_sink_stats(sink)
 
         print(f'成功爬取 {self.symbol}股吧共 {stop_page - page1 + 1} 页帖子，总计 {row_count} 条，花费 {time_cost/60:.2f} 分钟')
         print(f'帖子的时间范围从 {start_date} 到 {end_date}')
 
+    def crawl_incremental(self, max_pages: int = None):
+        """
+        从第 1 页向后爬取，直到某一整页都是已经入库的帖子（置顶、热门的旧帖不影响判断）
+        :param max_pages: 最多爬取的页数，默认不限制
+        """
+        if self.list_order != 'post':
+            raise ValueError("增量爬取需要按发帖时间排列的列表页（list_order='post'）")
+        parser = self.new_post_parser()
+        postdb = MongoAPI('post_info', f'post_{self.symbol}')
+        high_water = CrawlCheckpoint(f'incremental_{self.symbol}')  # the newest post we have ever stored
+        state = high_water.load()
+        if state is None:  # the first run starts from the newest post a full crawl_post_info stored
+            last = postdb.find_last() or {'_id': 0}
+            state = {'post_id': last['_id'], 'post_url': last.get('post_url')}
+        newest = dict(state)
+        current_page = 1
+
+        try:
+            if self.fetcher is None:
+                self.create_webdriver()
+            stop_page = max_pages or self.get_page_num()
+            while current_page <= stop_page:
+                url = self.list_url(current_page)
+                try:
+                    posts = [dic for dic in self.fetch_post_page(parser, url, current_page == 1)
+                             if self.is_post_url(dic['post_url'])]
+                    known = {doc['_id'] for doc in
+                             postdb.find({'_id': {'$in': [dic['_id'] for dic in posts]}}, {'_id': 1})}
+                    dic_list = [dic for dic in posts if dic['_id'] not in known]
+                    with METRICS.timer('db_insert', **self.labels):
+                        postdb.bulk_upsert(posts)  # known posts get their fresh comment_num and post_view
+                    self.remember_posts(posts)
+                    self.row_count += len(dic_list)
+                    METRICS.inc('guba_pages_total', kind='post_list', status='ok', **self.labels)
+                    METRICS.inc('guba_rows_total', len(dic_list), kind='post', **self.labels)
+                    for dic in posts:  # a known post may be newer too, stored by another crawl since the last run
+                        if dic['_id'] > newest['post_id']:
+                            newest = {'post_id': dic['_id'], 'post_url': dic['post_url']}
+                    print(f'{self.symbol}: 第 {current_page} 页共 {len(posts)} 条帖子，新增 {len(dic_list)} 条')
+                    current_page += 1
+
+                    # a page with nothing new below the high-water mark means the rest was crawled before
+                    if posts and all(dic['_id'] in known or dic['_id'] <= state['post_id'] for dic in posts):
+                        break
+
+                except Exception as e:
+                    print(f'{self.symbol}: 第 {current_page} 页出现了错误 {e}')
+                    METRICS.inc('guba_retries_total', kind='post_list', **self.labels)
+                    time.sleep(0.01)
+                    self.restart_webdriver()
+        finally:  # a failed run must not leave chrome running in the scheduler's worker
+            self.quit_webdriver()
+            self.save_seen()
+
+        high_water.save(**newest)  # only after a finished run, an interrupted one would skip the pages between
+        time_cost = time.time() - self.start
+        print(f'增量爬取 {self.symbol}股吧 {current_page - 1} 页，新增 {self.row_count} 条帖子，花费 {time_cost/60:.2f} 分钟')
+        print(f'最新帖子 id {newest["post_id"]} （{newest["post_url"]}）')
+
 
 class CommentCrawler(object):
 
-    def __init__(self, stock_symbol: str):
+    def __init__(self, stock_symbol: str, backend: str = 'browser', reply_api_url: str = REPLY_API_URL,
+                 reply_concurrency: int = 4, driver_pool: DriverPool = None, limiter: AdaptiveRateLimiter = LIMITER,
+                 ready_timeout: float = 3.0, seen_dir: str = None):
+        """
+        :param backend: 'browser' 用 selenium 渲染帖子页面，只能读到第一屏的回复，评论数多于这些的帖子记为不完整;
+                        'api' 直接请求回复数据接口并抓取全部回复页，失败时才回退到浏览器
+        :param reply_api_url: 回复接口地址，可以指向本地提供录制 JSON 的服务器
+        :param reply_concurrency: 'api' 方式下同时请求的回复页数（一个帖子的第 2 页及以后）
+        :param driver_pool: 共享的预热浏览器池，默认由爬虫自己创建并在结束时关闭
+        :param limiter: 按域名自适应的限速器，默认整个进程共用一个
+        :param ready_timeout: 等待评论出现的上限（秒），超时则刷新页面
+        :param seen_dir: 已爬评论帖子 filter 文件的目录，之前爬过评论的帖子不再打开；None 表示不使用
+        """
         self.browser = None
         self.symbol = stock_symbol
+        self.limiter = limiter
+        self.labels = {'symbol': stock_symbol, 'backend': backend}  # of the metrics
+        self.readiness = ReadinessWaiter(timeout=ready_timeout, labels={'symbol': stock_symbol, 'backend': 'browser'})
+        self.reply_api = None
+        if backend == 'api':
+            self.reply_api = ReplyApiClient(HttpFetcher(pool_size=reply_concurrency), api_url=reply_api_url)
+        self.reply_concurrency = reply_concurrency
+        self.missing_pages = 0  # reply pages still failing after the retry
+        self.incomplete = []  # posts left with missing reply pages, a resumed run crawls them again
+        self.seen = None
+        if seen_dir:
+            commentdb = MongoAPI('comment_info', f'comment_{stock_symbol}')
+            self.seen = SeenPosts(os.path.join(seen_dir, f'comments_{stock_symbol}.bloom'),
+                                  lambda post_id: commentdb.find_one({'post_id': post_id}, {'_id': 1}) is not None)
+        self.own_pool = driver_pool is None
+        self.driver_pool = driver_pool or DriverPool()
         self.start = time.time()
-        self.post_df = None  # dataframe about the post_url and post_id
+        self.post_query = None  # (collection, query) of the selected posts, read lazily by 'iter_posts'
+        self.post_total = 0
+        self.delta = None  # post_id -> comment counts of the posts selected by 'find_changed'
+        self.delta_postdb = None
+        self.reply_pages = 0  # reply pages requested by the api backend
+        self.checkpoint = None  # frontier of the selected posts, the last finished post_id
         self.current_num = 0
+        self.row_count = 0  # comments inserted by this crawler
 
     def create_webdriver(self):
-        options = webdriver.ChromeOptions()  # configure the webdriver
-        options.add_argument('lang=zh_CN.UTF-8')
-        options.add_argument('user-agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, '
-                             'like Gecko) Chrome/111.0.0.0 Safari/537.36"')
-        self.browser = webdriver.Chrome(options=options)
-        # self.browser.set_page_load_timeout(2)  # set the timeout restrict
-
-        current_dir = os.path.dirname(os.path.abspath(__file__))  # hide the features of crawler/selenium
-        js_file_path = os.path.join(current_dir, 'stealth.min.js')
-        with open(js_file_path) as f:
-            js = f.read()
-        self.browser.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {
-            "source": js
-        })
-
-    def find_by_date(self, start_date, end_date):
+        self.browser = self.driver_pool.acquire()  # a warmed session if there is one
+
+    def ensure_webdriver(self):
+        if self.browser is None:  # the api backend only starts chrome when a post falls back to the page
+            self.create_webdriver()
+
+    def quit_webdriver(self):
+        if self.browser is not None:
+            self.driver_pool.release(self.browser)
+            self.browser = None
+        if self.own_pool:
+            self.driver_pool.close()
+        if self.reply_api is not None:
+            self.reply_api.fetcher.close()
+
+    def resume_from(self, selection: str, resume: bool):
+        # posts are crawled in '_id' order, so everything up to the saved post_id is already finished
+        self.checkpoint = CrawlCheckpoint(f'comment_{self.symbol}_{selection}')
+        state = self.checkpoint.load() if resume else None
+        if state is None:
+            return None
+        print(f'{self.symbol}: 从断点 id {state["post_id"]} 之后继续爬取评论')
+        return state['post_id']
+
+    def find_by_date(self, start_date, end_date, resume: bool = True):
         # get comment urls through date (used for the first crawl)
         """
         :param start_date: '2003-07-21' 字符串格式 ≥
         :param end_date: '2024-07-21' 字符串格式 ≤
+        :param resume: 跳过上次中断前已经爬完的帖子
         """
         postdb = MongoAPI('post_info', f'post_{self.symbol}')
         time_query = {
             'post_date': {'$gte': start_date, '$lte': end_date},
             'comment_num': {'$ne': 0}  # avoid fetching urls with no comment
         }
-        post_info = postdb.find(time_query, {'_id': 1, 'post_url': 1})  # , 'post_date': 1
-        self.post_df = pd.DataFrame(post_info)
+        last_id = self.resume_from(f'date_{start_date}_{end_date}', resume)
+        if last_id is not None:
+            time_query['_id'] = {'$gt': last_id}
+        self.select_posts(postdb, time_query)
 
-    def find_by_id(self, start_id: int, end_id: int):
+    def find_by_id(self, start_id: int, end_id: int, resume: bool = True):
         # get comment urls through post_id (used when crawler is paused accidentally) crawl in batches
         """
-        :param start_id: 721 整数 ≥
-        :param end_id: 2003 整数 ≤
+        :param start_id: 1599000000 整数 ≥ （帖子链接中的 id）
+        :param end_id: 1599326398 整数 ≤
+        :param resume: 跳过上次中断前已经爬完的帖子
         """
         postdb = MongoAPI('post_info', f'post_{self.symbol}')
         id_query = {
             '_id': {'$gte': start_id, '$lte': end_id},
             'comment_num': {'$ne': 0}  # avoid fetching urls with no comment
         }
-        post_info = postdb.find(id_query, {'_id': 1, 'post_url': 1})  # , 'post_date': 1
-        self.post_df = pd.DataFrame(post_info)
-
-    def crawl_comment_info(self):
-        url_df = self.post_df['post_url']
-        id_df = self.post_df['_id']
-        total_num = self.post_df.shape[0]
-
-        self.create_webdriver()
-        parser = CommentParser()
+        last_id = self.resume_from(f'id_{start_id}_{end_id}', resume)
+        if last_id is not None:
+            id_query['_id']['$gt'] = last_id
+        self.select_posts(postdb, id_query)
+
+    def find_changed(self, start_date: str = None, end_date: str = None, resume: bool = True,
+                     batch_size: int = 1000):
+        # delta mode (used for the daily re-crawl): only the posts whose comment_num on the list page grew
+        # beyond the comments stored for them, and only their missing tail of replies is fetched
+        """
+        :param start_date/end_date: 只比较这段发帖日期内的帖子，None 表示全部帖子
+        :param resume: 跳过上次中断前已经爬完的帖子
+        :param batch_size: 每次从 mongo 读取并统计的帖子数
+        """
+        postdb = MongoAPI('post_info', f'post_{self.symbol}')
         commentdb = MongoAPI('comment_info', f'comment_{self.symbol}')
-
-        for url in url_df:
-            try:
-                time.sleep(abs(random.normalvariate(0.03, 0.01)))  # random sleep time
-
-                try:  # sometimes the website needs to be refreshed (situation comment is loaded unsuccessfully)
-                    self.browser.get(url)  # this function may also get timeout exception
-                    WebDriverWait(self.browser, 0.2, poll_frequency=0.1).until(
-                        EC.presence_of_element_located((By.CSS_SELECTOR, 'div.reply_item.cl')))
-                except TimeoutException:  # timeout situation
-                    self.browser.refresh()
-                    print('------------ refresh ------------')
-                finally:
-                    reply_items = self.browser.find_elements(By.CSS_SELECTOR, 'div.allReplyList > div.replylist_content > div.reply_item.cl')  # some have hot reply list avoid fetching twice
-
-                dic_list = []  # as batch insert is more efficient than insert one
-                for item in reply_items:
-                    dic = parser.parse_comment_info(item, id_df.iloc[self.current_num].item())
-                    # save the related post_id
+        query = {'comment_num': {'$gt': 0}}
+        if start_date is not None and end_date is not None:
+            query['post_date'] = {'$gte': start_date, '$lte': end_date}
+        selection = f'delta_{start_date}_{end_date}'
+        last_id = self.resume_from(selection, resume)
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+
+        delta = {}
+        checked = 0
+        cursor = postdb.find(query, {'_id': 1, 'post_url': 1, 'comment_num': 1, 'crawled_comment_num': 1})
+        cursor = cursor.sort('_id', 1).batch_size(batch_size)
+        while True:
+            batch = list(islice(cursor, batch_size))
+            if not batch:
+                break
+            checked += len(batch)
+            stored = self.stored_counts(commentdb, [post['_id'] for post in batch])
+            for post in batch:
+                rows, replies = stored.get(post['_id'], (0, 0))
+                # hidden or deleted replies are counted but never stored, so also compare with the
+                # comment_num of the last delta crawl, otherwise such posts would be queued every day
+                if post['comment_num'] > max(rows, post.get('crawled_comment_num') or 0):
+                    delta[post['_id']] = {'post_url': post['post_url'], 'comment_num': post['comment_num'],
+                                          'rows': rows, 'replies': replies}
+        self.select_changed(postdb, delta)
+        print(f'{self.symbol}: 比较了 {checked} 个帖子的评论数，{self.post_total} 个有新评论，'
+              f'预计新增 {sum(post["comment_num"] - post["rows"] for post in self.delta.values())} 条')
+
+    def select_changed(self, postdb, delta, selection: str = None):
+        """
+        :param delta: {post_id: {'post_url', 'comment_num', 'rows', 'replies'}}，按爬取顺序排列；
+                      rows、replies 是已入库的评论数和其中的一级回复数（见 stored_counts）
+        :param selection: 断点名称，传入时重新开始（不从断点继续）
+        """
+        self.delta, self.delta_postdb = delta, postdb
+        self.post_total = len(delta)
+        if selection is not None:
+            self.resume_from(selection, resume=False)
+
+    @staticmethod
+    def stored_counts(commentdb, post_ids):
+        # post_id -> (stored rows, stored top-level replies), one aggregation per batch of posts
+        pipeline = [
+            {'$match': {'post_id': {'$in': post_ids}}},
+            {'$group': {'_id': '$post_id', 'rows': {'$sum': 1},
+                        'replies': {'$sum': {'$cond': ['$sub_comment', 0, 1]}}}},
+        ]
+        return {group['_id']: (group['rows'], group['replies']) for group in commentdb.aggregate(pipeline)}
+
+    def first_reply_page(self, post_id):
+        # replies are listed oldest first (sort=1), so the new ones are on the last stored page and after it;
+        # the last stored page is fetched again as it may have been partly filled, re-crawled rows upsert in place
+        if self.delta is None:
+            return 1
+        return max(1, math.ceil(self.delta[post_id]['replies'] / self.reply_api.page_size))
+
+    def select_posts(self, postdb, query):
+        # only the count is read here, the posts themselves stream in while crawling
+        self.post_query = (postdb, query)
+        self.post_total = postdb.count_documents(query)
+
+    def iter_posts(self, batch_size: int = 1000):
+        # (post_id, post_url, comment_num) in '_id' order, one batch in memory at a time; every batch is its own
+        # query after the last '_id', a cursor kept open over a long crawl would be closed by the server's idle timeout
+        if self.delta is not None:  # already selected by 'find_changed'
+            for post_id, post in self.delta.items():
+                yield post_id, post['post_url'], post['comment_num']
+            return
+        postdb, query = self.post_query
+        page_query = query
+        while True:
+            batch = list(postdb.find(page_query, {'_id': 1, 'post_url': 1, 'comment_num': 1})
+                         .sort('_id', 1).limit(batch_size))
+            for post in batch:
+                yield post['_id'], post['post_url'], post.get('comment_num')
+            if len(batch) < batch_size:
+                return
+            page_query = {'$and': [query, {'_id': {'$gt': batch[-1]['_id']}}]}
+
+    def parse_comment_page(self, parser, post_id):
+        try:  # one page_source snapshot instead of a WebDriver round trip for every field
+            return parser.parse_comment_page(self.browser.page_source, post_id)
+        except Exception as e:  # fall back to the WebDriver elements if the snapshot can not be parsed
+            print(f'{self.symbol}: 页面快照解析失败 {e}，改用逐元素解析')
+
+        dic_list = []
+        # some have hot reply list avoid fetching twice
+        reply_items = self.browser.find_elements(By.CSS_SELECTOR, 'div.allReplyList > div.replylist_content > div.reply_item.cl')
+        for item in reply_items:
+            dic = parser.parse_comment_info(item, post_id)  # save the related post_id
+            dic_list.append(dic)
+
+            if parser.judge_sub_comment(item):  # means it has sub-comments
+                sub_reply_items = item.find_elements(By.CSS_SELECTOR, 'li.reply_item_l2')
+
+                for subitem in sub_reply_items:
+                    dic = parser.parse_comment_info(subitem, post_id, True)  # as it has sub-comments
                     dic_list.append(dic)
+        return parser.number_duplicates(dic_list)
+
+    def fetch_reply_page(self, post_id, page: int, url):
+        api_url = self.reply_api.api_url
+        self.limiter.wait(api_url)
+        try:
+            with METRICS.timer('navigation', symbol=self.symbol, backend='api'):
+                data = self.reply_api.fetch_page(post_id, page, referer=url)
+        except Exception:
+            self.limiter.throttled(api_url, 'error')
+            raise
+        self.limiter.success(api_url)
+        return data
+
+    def stream_api_comments(self, parser, sink, url, post_id, pool, first_page: int = 1):
+        # the first page tells the reply count, the remaining pages are fetched concurrently; a page goes to
+        # the sink once it and the pages before it are parsed, so identical replies are numbered in thread order
+        # (a delta run starting at a later page numbers them from there)
+        counts = {}
+        data = self.fetch_reply_page(post_id, first_page, url)
+        with METRICS.timer('parse', symbol=self.symbol, backend='api'):
+            dic_list = parser.parse_reply_data(data, post_id, number=False)
+        if not dic_list:  # only posts with comments are selected
+            self.limiter.throttled(self.reply_api.api_url, 'empty')
+            raise ValueError('回复接口没有返回评论')
+        sink.put_many(parser.number_duplicates(dic_list, counts))
+        row_count = len(dic_list)
+
+        futures = {pool.submit(self.fetch_reply_page, post_id, page, url): page
+                   for page in range(first_page + 1, self.reply_api.page_count(data) + 1)}
+        self.reply_pages += 1 + len(futures)
+        parsed = {}  # page -> rows waiting for the pages before them
+        next_page = first_page + 1
+        failed = []
+        for future in as_completed(futures):
+            try:
+                data = future.result()
+                with METRICS.timer('parse', symbol=self.symbol, backend='api'):
+                    parsed[futures[future]] = parser.parse_reply_data(data, post_id, number=False)
+            except Exception as e:  # keep the other pages of a big thread, the failed ones are retried below
+                failed.append(futures[future])
+                print(f'{self.symbol}: 帖子 {post_id} 第 {futures[future]} 页回复请求失败 {e}')
+                continue
+            while next_page in parsed:
+                dic_list = parsed.pop(next_page)
+                sink.put_many(parser.number_duplicates(dic_list, counts))
+                row_count += len(dic_list)
+                next_page += 1
+        missing = 0
+        for page in sorted(failed):  # once more, one at a time now that the limiter has slowed down
+            METRICS.inc('guba_retries_total', kind='reply_page', **self.labels)
+            self.reply_pages += 1
+            try:
+                data = self.fetch_reply_page(post_id, page, url)
+                with METRICS.timer('parse', symbol=self.symbol, backend='api'):
+                    parsed[page] = parser.parse_reply_data(data, post_id, number=False)
+            except Exception as e:
+                missing += 1
+                print(f'{self.symbol}: 帖子 {post_id} 第 {page} 页回复重试失败 {e}')
+        for page in sorted(parsed):  # the pages behind a failed one
+            dic_list = parsed.pop(page)
+            sink.put_many(parser.number_duplicates(dic_list, counts))
+            row_count += len(dic_list)
+        self.missing_pages += missing
+        return row_count, missing == 0
+
+    def fetch_page_comments(self, parser, url, post_id):
+        self.ensure_webdriver()
+        self.limiter.wait(url)
+        try:  # sometimes the website needs to be refreshed (situation comment is loaded unsuccessfully)
+            with METRICS.timer('navigation', symbol=self.symbol, backend='browser'):
+                self.browser.get(url)  # this function may also get timeout exception
+            ready = self.readiness.wait_browser(self.browser, [COMMENT_ROW], 'comment')
+        except TimeoutException:  # timeout situation
+            ready = False
+        if ready:
+            self.limiter.success(url)
+        else:  # only posts with comments are selected, so no comment in time means restricted or broken
+            self.limiter.throttled(url, 'timeout' if expected_title(self.browser.title) else 'title')
+            self.browser.refresh()
+            print('------------ refresh ------------')
+        self.browser = self.driver_pool.report(self.browser, ok=ready)  # a restricted session gets recycled
+        with METRICS.timer('parse', symbol=self.symbol, backend='browser'):
+            dic_list = self.parse_comment_page(parser, post_id)
+        if self.reply_api is not None:
+            self.reply_api.fetcher.load_browser_cookies(self.browser)  # keep the api session as the browser visitor
+        return dic_list
+
+    def crawl_post_comments(self, parser, sink, url, post_id, pool=None, comment_num: int = None):
+        # stores the comments of one post, returns how many were parsed and whether all of them were
+        if self.reply_api is not None:
+            try:
+                return self.stream_api_comments(parser, sink, url, post_id, pool, self.first_reply_page(post_id))
+            except Exception as e:  # the rendered page is still there as a fallback (its first view only)
+                METRICS.inc('guba_retries_total', kind='browser_fallback', **self.labels)
+                print(f'{self.symbol}: 回复接口请求失败 {e}，改用浏览器 （{url}）')
+        # as batch insert is more efficient than insert one
+        dic_list = self.fetch_page_comments(parser, url, post_id)
+        sink.put_many(dic_list)
+        # the rendered page shows the first view only: a thread with more comments than that is truncated
+        # ('comment_num' of the list page counts the sub-replies too, like the parsed rows)
+        complete = self.reply_api is None and len(dic_list) >= (comment_num or 0)
+        if self.reply_api is None and not complete:
+            print(f'{self.symbol}: 帖子 {post_id} 只读到 {len(dic_list)}/{comment_num} 条评论（页面第一屏）')
+        return len(dic_list), complete
+
+    def finish_post(self, sink, post_id, complete: bool = True, skipped: bool = False):
+        # the post is finished once everything queued before this marker is written; the frontier stops
+        # before the first post with missing comments, so a resumed run crawls it (and the rest) again,
+        # a 'skipped' post (its comments cannot be displayed) is passed as it would fail the same way
+        if not complete and not skipped:
+            self.incomplete.append(post_id)
+        sink.put_many([], on_flushed=functools.partial(self.post_finished, sink.mongo, post_id,
+                                                       complete and not skipped, not self.incomplete))
+
+    def post_finished(self, commentdb, post_id, complete: bool = True, advance: bool = True):
+        if advance and self.checkpoint is not None:  # 'select_changed' without a selection has none
+            self.checkpoint.save(post_id=post_id)
+        if self.delta is not None:  # queued again only when comment_num grows past what this crawl stored
+            # comment_num is only reached when every reply page arrived, otherwise what is actually there
+            crawled = (self.delta[post_id]['comment_num'] if complete
+                       else commentdb.count_documents({'post_id': post_id}))
+            self.delta_postdb.bulk_upsert([{'_id': post_id, 'crawled_comment_num': crawled}])
+
+    def write_delta_report(self, commentdb, path: str = None, batch_size: int = 1000):
+        # stored comments of the changed posts before and after the crawl, instead of counting them by hand
+        post_ids = list(self.delta)
+        final_rows = sum(rows for start in range(0, len(post_ids), batch_size)
+                         for rows, _ in self.stored_counts(commentdb, post_ids[start:start + batch_size]).values())
+        initial_rows = sum(post['rows'] for post in self.delta.values())
+        report = {
+            'timestamp': datetime.now().isoformat(),
+            'stock_code': self.symbol,
+            'changed_posts': len(post_ids),
+            'crawled_posts': self.current_num,
+            'expected_new_comments': sum(post['comment_num'] - post['rows'] for post in self.delta.values()),
+            'initial_comments': initial_rows,
+            'final_comments': final_rows,
+            'new_comments': final_rows - initial_rows,
+            'reply_pages': self.reply_pages,
+        }
+        path = path or f'comment_crawl_result_{self.symbol}.json'
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"{self.symbol}: {report['changed_posts']} 个帖子新增 {report['new_comments']} 条评论"
+              f"（预计 {report['expected_new_comments']} 条），结果已写入 {path}")
+        return report
+
+    def crawl_comment_info(self, batch_size: int = 1000, report_path: str = None):
+        """
+        :param batch_size: 每次从 mongo 读取的帖子数
+        :param report_path: 增量模式（find_changed）的结果文件，默认 comment_crawl_result_{股票代码}.json
+        """
+        if self.post_query is None and self.delta is None:
+            raise ValueError('请先用 find_by_date、find_by_id、find_changed 或 select_changed 选择要爬取评论的帖子')
+        total_num = self.post_total
 
-                    if parser.judge_sub_comment(item):  # means it has sub-comments
-                        sub_reply_items = item.find_elements(By.CSS_SELECTOR, 'li.reply_item_l2')
-
-                        for subitem in sub_reply_items:
-                            dic = parser.parse_comment_info(subitem, id_df.iloc[self.current_num].item(), True)
-                            # as it has sub-comments
-                            dic_list.append(dic)
-
-                commentdb.insert_many(dic_list)
-                self.current_num += 1
-                print(f'{self.symbol}: 已成功爬取 {self.current_num} 页评论信息，进度 {self.current_num*100/total_num:.3f}%')
+        parser = CommentParser()
+        commentdb = MongoAPI('comment_info', f'comment_{self.symbol}')
 
-            except TypeError as e:  # some comment is not allowed to display, just skip it
-                self.current_num += 1
-                print(f'{self.symbol}: 第 {self.current_num} 页出现了错误 {e} （{url}）')  # maybe the invisible comments
-                print(f'应爬取的id范围是 {id_df.iloc[0]} 到 {id_df.iloc[-1]}, id {id_df.iloc[self.current_num - 1]} 出现了错误')
-                self.browser.delete_all_cookies()
-                self.browser.refresh()
-                self.browser.quit()  # restart webdriver if crawler is restricted
+        sink = BufferedMongoSink(commentdb, labels=self.labels)  # mongo writes run behind the browser
+        pool = ThreadPoolExecutor(max_workers=self.reply_concurrency) if self.reply_api is not None else None
+        try:
+            if self.reply_api is None:
                 self.create_webdriver()
-
+            for post_id, url, comment_num in self.iter_posts(batch_size):
+                # its comments were stored by an earlier run (delta mode selects exactly such posts)
+                if self.delta is None and self.seen is not None and self.seen.seen(post_id):
+                    self.finish_post(sink, post_id)
+                    self.current_num += 1
+                    METRICS.inc('guba_pages_total', kind='post', status='seen', **self.labels)
+                    continue
+                try:
+                    row_count, complete = self.crawl_post_comments(parser, sink, url, post_id, pool, comment_num)
+                    self.row_count += row_count
+                    METRICS.inc('guba_pages_total', kind='post', status='ok' if complete else 'partial', **self.labels)
+                    METRICS.inc('guba_rows_total', row_count, kind='comment', **self.labels)
+                    self.finish_post(sink, post_id, complete)
+                    if self.seen is not None and complete:
+                        self.seen.add(post_id)
+                    self.current_num += 1
+                    print(f'{self.symbol}: 已成功爬取 {self.current_num} 页评论信息，进度 {self.current_num*100/total_num:.3f}%，'
+                          f'当前速率 {self.limiter.rate(url):.2f} 页/秒')
+
+                except TypeError as e:  # some comment is not allowed to display, just skip it
+                    self.finish_post(sink, post_id, skipped=True)
+                    self.current_num += 1
+                    METRICS.inc('guba_pages_total', kind='post', status='error', **self.labels)
+                    print(f'{self.symbol}: 第 {self.current_num} 页出现了错误 {e} （{url}）')  # maybe the invisible comments
+                    print(f'id {post_id} 出现了错误')
+                    if self.browser is None:
+                        continue
+                    METRICS.inc('guba_browser_restarts_total', **self.labels)
+                    with METRICS.timer('browser_restart', **self.labels):
+                        try:
+                            self.browser.delete_all_cookies()
+                            # swapped for a warmed spare once the recent error rate shows we are restricted
+                            self.browser = self.driver_pool.report(self.browser, ok=False)
+                        except Exception:  # the session itself is broken
+                            self.browser = self.driver_pool.replace(self.browser)
+        finally:
+            if pool is not None:  # an interrupted crawl drops the reply pages still waiting for a worker
+                pool.shutdown(cancel_futures=True)
+            self.quit_webdriver()  # a failed task must not leave chrome running in the scheduler's worker
+            sink.close()  # also flushes the finished posts when the crawl is interrupted
+            if self.seen is not None:
+                self.seen.save()
+
+        if self.incomplete:  # the checkpoint stays before the first of them
+            reason = (f'{self.missing_pages} 页回复请求失败' if self.reply_api is not None
+                      else "浏览器方式只能读到第一屏的回复，用 backend='api' 可以抓取全部回复页")
+            print(f'{self.symbol}: {len(self.incomplete)} 个帖子的评论不完整（{reason}），'
+                  f'再次运行时从帖子 {self.incomplete[0]} 继续')
+        elif self.checkpoint is not None:
+            self.checkpoint.clear()  # all the selected posts are finished
+        if self.delta is not None:
+            self.write_delta_report(commentdb, report_path)
+        if self.seen is not None and self.delta is None:
+            print(f'{self.symbol}: 跳过 {self.seen.hits} 个之前已爬过评论的帖子，filter 误判 {self.seen.false_positives} 次')
         end = time.time()
         time_cost = end - self.start
         row_count = commentdb.count_documents()
-        self.browser.quit()
+        PostCrawler.print_sink_stats(sink)
+        for line in self.readiness.describe():
+            print(line)
         print(f'成功爬取 {self.symbol}股吧 {self.current_num} 页评论，共 {row_count} 条，花费 {time_cost/60:.2f}分钟')
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Apify 数据集的流式写入
+记录解析后先进入有界缓冲区，满一批即推送，运行结束（或出错退出）时推送剩余部分
+"""
+
+import asyncio
+import logging
+
+
+class DatasetWriter:
+    """按批推送记录，内存占用与爬取规模无关"""
+
+    def __init__(self, push, batch_size=50):
+        """
+        :param push: 推送一批记录的协程函数，例如 Actor.push_data
+        :param batch_size: 每批推送的记录数
+        """
+        self.push = push
+        self.batch_size = batch_size
+        self.logger = logging.getLogger(__name__)
+
+        self.buffer = []
+        self.lock = asyncio.Lock()  # 并发的评论任务共用一个缓冲区
+        self.pushed = 0
+        self.batches = 0
+
+    async def add(self, record):
+        """加入一条记录，缓冲区满时推送"""
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """推送缓冲区中的全部记录"""
+        async with self.lock:
+            while self.buffer:  # 等锁期间其他任务可能又加入了记录，每批仍不超过 batch_size
+                batch, self.buffer = self.buffer[:self.batch_size], self.buffer[self.batch_size:]
+                try:
+                    await self.push(batch)
+                except Exception:
+                    self.buffer = batch + self.buffer  # 留给下一次推送（或退出时的 flush）
+                    raise
+                self.pushed += len(batch)
+                self.batches += 1
+                self.logger.info(f"✅ 已推送 {len(batch)} 条记录到数据集，累计 {self.pushed} 条")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # 出错退出时也推送已解析的记录
+        await self.flush()
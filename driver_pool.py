@@ -0,0 +1,141 @@
+from selenium import webdriver
+from collections import deque
+import os
+import queue
+import threading
+
+from metrics import METRICS
+
+
+STEALTH_JS = None  # read stealth.min.js only once per process
+
+
+def load_stealth_js():
+    global STEALTH_JS
+    if STEALTH_JS is None:
+        current_dir = os.path.dirname(os.path.abspath(__file__))  # hide the features of crawler/selenium
+        with open(os.path.join(current_dir, 'stealth.min.js')) as f:
+            STEALTH_JS = f.read()
+    return STEALTH_JS
+
+
+def create_webdriver():
+    options = webdriver.ChromeOptions()  # configure the webdriver
+    options.add_argument('lang=zh_CN.UTF-8')
+    options.add_argument('user-agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, '
+                         'like Gecko) Chrome/111.0.0.0 Safari/537.36"')
+    browser = webdriver.Chrome(options=options)
+    browser.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {
+        "source": load_stealth_js()
+    })
+    return browser
+
+
+class DriverPool(object):
+    # keeps pre-warmed chrome sessions, so a failing session is swapped at once instead of booting a new one
+
+    def __init__(self, spares: int = 1, max_requests: int = 600, error_window: int = 20,
+                 max_error_rate: float = 0.3, factory=create_webdriver):
+        """
+        :param spares: 预热备用的浏览器数量
+        :param max_requests: 一个浏览器最多使用的请求数（东方财富约 660 页后开始限制访问）
+        :param error_window: 统计错误率的最近请求数
+        :param max_error_rate: 最近请求的错误率超过该值时退役浏览器
+        """
+        self.spares = spares
+        self.max_requests = max_requests
+        self.error_window = error_window
+        self.max_error_rate = max_error_rate
+        self.factory = factory
+        self.ready = queue.Queue()  # warmed sessions
+        self.warming = 0
+        self.lock = threading.Lock()
+        self.health = {}  # id(browser) -> {'requests': n, 'recent': deque of bools}
+        self.closed = False
+        self.threads = []  # background warm and quit threads, 'close' waits for them
+        self.created = 0
+        self.retired = 0
+
+    def warm(self):
+        # top the spares up in background threads
+        with self.lock:
+            missing = self.spares - self.ready.qsize() - self.warming
+            self.warming += max(missing, 0)
+        for _ in range(missing):
+            self.start_thread(self.warm_one)
+
+    def start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        with self.lock:
+            self.threads = [running for running in self.threads if running.is_alive()]
+            self.threads.append(thread)
+        thread.start()
+
+    def warm_one(self):
+        try:
+            with METRICS.timer('browser_start', mode='warm'):
+                browser = self.factory()
+            self.created += 1
+            METRICS.inc('guba_browser_sessions_total', event='created')
+        except Exception as e:
+            print(f'预热浏览器失败 {e}')
+            browser = None
+        with self.lock:
+            self.warming -= 1
+            if browser is not None and self.closed:
+                self.quit(browser)
+            elif browser is not None:
+                self.ready.put(browser)
+
+    def acquire(self):
+        try:
+            browser = self.ready.get_nowait()
+        except queue.Empty:  # nothing warmed yet, boot one in the foreground
+            with METRICS.timer('browser_start', mode='foreground'):
+                browser = self.factory()
+            self.created += 1
+            METRICS.inc('guba_browser_sessions_total', event='created')
+        self.health[id(browser)] = {'requests': 0, 'recent': deque(maxlen=self.error_window)}
+        self.warm()
+        return browser
+
+    def report(self, browser, ok: bool):
+        # record one request, returns the session to continue with (a spare one if this got unhealthy)
+        health = self.health[id(browser)]
+        health['requests'] += 1
+        health['recent'].append(ok)
+        errors = health['recent'].count(False)
+        unhealthy = (health['requests'] >= self.max_requests or
+                     (len(health['recent']) >= min(5, self.error_window) and
+                      errors / len(health['recent']) > self.max_error_rate))
+        return self.replace(browser) if unhealthy else browser
+
+    def replace(self, browser):
+        # the session is dead or banned, swap it for a warmed one right away
+        self.release(browser)
+        return self.acquire()
+
+    def release(self, browser):
+        # quitting chrome is slow too, let it happen in the background ('close' waits for it)
+        self.health.pop(id(browser), None)
+        self.retired += 1
+        METRICS.inc('guba_browser_sessions_total', event='retired')
+        self.start_thread(self.quit, browser)
+
+    @staticmethod
+    def quit(browser):
+        try:
+            browser.quit()
+        except Exception:
+            pass
+
+    def close(self):
+        # the process usually exits right after, so every session has to be quit before returning:
+        # the spares, the ones still quitting in the background and the ones still starting (quit by 'warm_one')
+        with self.lock:
+            self.closed = True
+            threads = list(self.threads)
+        while not self.ready.empty():
+            self.quit(self.ready.get_nowait())
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,155 @@
+import argparse
+import os
+import uuid
+
+from checkpoint import CrawlCheckpoint
+from mongodb import MongoAPI
+
+
+# column types of every exported table; the last two columns are the hive partitions (stock_code=.../date=...)
+SCHEMAS = {
+    # crawler.py documents in the post_info / comment_info databases
+    'post_info': [('post_id', 'int64'), ('post_title', 'string'), ('post_view', 'string'), ('comment_num', 'int64'),
+                  ('post_url', 'string'), ('post_time', 'string'), ('post_author', 'string'),
+                  ('stock_code', 'string'), ('post_date', 'string')],
+    'comment_info': [('comment_id', 'string'), ('post_id', 'int64'), ('comment_content', 'string'),
+                     ('comment_like', 'int64'), ('comment_time', 'string'), ('sub_comment', 'int8'),
+                     ('stock_code', 'string'), ('comment_date', 'string')],
+    # records of the playwright crawlers
+    'posts': [('title', 'string'), ('author', 'string'), ('post_time', 'string'), ('read_count', 'string'),
+              ('reply_count', 'string'), ('post_url', 'string'), ('stock_name', 'string'), ('crawl_time', 'string'),
+              ('stock_code', 'string'), ('post_date', 'string')],
+    'comments': [('author', 'string'), ('content', 'string'), ('comment_time', 'string'), ('floor_number', 'int64'),
+                 ('post_url', 'string'), ('crawl_time', 'string'), ('stock_code', 'string'),
+                 ('comment_date', 'string')],
+}
+
+UNKNOWN_DATE = 'unknown'  # partition of the posts whose date could not be parsed
+
+
+def require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+    except ImportError:  # only the export needs it, the crawlers run without
+        raise ImportError('导出 Parquet 需要 pyarrow，请先运行 pip install pyarrow') from None
+    return pyarrow, pyarrow.dataset
+
+
+def to_row(kind: str, record: dict, stock_code: str):
+    row = dict(record)
+    if kind == 'post_info':
+        row['post_id'] = row.pop('_id')
+    elif kind == 'comment_info':
+        row['comment_id'] = row.pop('_id')
+    elif kind == 'posts':  # 'YYYY-MM-DD HH:MM:SS'
+        row['post_date'] = (row.get('post_time') or '')[:10] or None
+    elif kind == 'comments':
+        row['comment_date'] = (row.get('comment_time') or '')[:10] or None
+    row['stock_code'] = row.get('stock_code') or stock_code
+    date_column = SCHEMAS[kind][-1][0]
+    row[date_column] = row.get(date_column) or UNKNOWN_DATE
+    return row
+
+
+class ParquetExporter(object):
+    # appends posts and comments to hive-partitioned parquet datasets, one directory per table:
+    # <root>/<kind>/stock_code=000002/post_date=2024-07-21/part-<run>-0.parquet
+
+    def __init__(self, root: str = 'parquet', compression: str = 'zstd'):
+        """
+        :param root: 数据集根目录，每种表一个子目录
+        :param compression: parquet 压缩算法，例如 'zstd'、'snappy'
+        """
+        self.root = root
+        self.compression = compression
+
+    def schema(self, kind: str):
+        pa, _ = require_pyarrow()
+        return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in SCHEMAS[kind]])
+
+    def write(self, kind: str, records, stock_code: str = None, replace: bool = False):
+        """
+        :param kind: 'post_info'、'comment_info'（mongo 文档）或 'posts'、'comments'（playwright 记录）
+        :param records: 字典列表，多余的字段会被忽略
+        :param stock_code: 记录中没有 stock_code 时使用
+        :param replace: 先删除这些记录所在分区的已有文件，而不是追加在旁边
+        :return: 写入的行数
+        """
+        pa, ds = require_pyarrow()
+        if not records:
+            return 0
+        schema = self.schema(kind)
+        rows = [to_row(kind, record, stock_code) for record in records]
+        table = pa.Table.from_pylist([{name: row.get(name) for name in schema.names} for row in rows], schema=schema)
+        partitions = [name for name, _ in SCHEMAS[kind][-2:]]
+        ds.write_dataset(
+            table, os.path.join(self.root, kind), format='parquet',
+            partitioning=ds.partitioning(pa.schema([schema.field(name) for name in partitions]), flavor='hive'),
+            # a new file name for every call, so later runs append next to the existing files
+            basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet',
+            existing_data_behavior='delete_matching' if replace else 'overwrite_or_ignore',
+            file_options=ds.ParquetFileFormat().make_write_options(compression=self.compression),
+        )
+        return table.num_rows
+
+    def export_collection(self, kind: str, symbol: str, query: dict = None, batch_size: int = 50000,
+                          full: bool = False):
+        """
+        直接从 mongo 导出一只股票的帖子或评论，按日期分区逐个导出并替换该分区的已有文件，重复导出不会产生重复行；
+        导出到的最后日期记录在 crawl_state.checkpoint 中，下次只重新导出这一天及之后的分区
+        :param kind: 'post_info' 或 'comment_info'
+        :param query: 额外的筛选条件，例如 {'post_date': {'$gte': '2024-01-01'}}，导出的分区只包含满足条件的记录；
+                      带筛选条件的导出总是导出所有满足条件的分区，不推进上次导出的日期，只会把它退回到替换过的最早分区
+        :param batch_size: 每次从 mongo 读取的记录数，内存占用与集合大小无关
+        :param full: 忽略上次导出的日期，重新导出所有分区
+        """
+        prefix = 'post' if kind == 'post_info' else 'comment'
+        collection = MongoAPI(kind, f'{prefix}_{symbol}')
+        date_column = SCHEMAS[kind][-1][0]
+        watermark = CrawlCheckpoint(f'export_{kind}_{symbol}')
+        filtered = bool(query)
+        saved = watermark.load()
+        state = None if full or filtered else saved
+        query = query or {}
+        groups = [group['_id'] for group in collection.aggregate([{'$match': query},
+                                                                  {'$group': {'_id': f'${date_column}'}}])]
+        # the last exported day may have grown since, the unknown partition is small and always redone
+        dates = sorted(date for date in groups if date and (state is None or date >= state['date']))
+        if any(not group for group in groups):
+            dates.append(None)
+        row_count = 0
+        for date in dates:
+            date_query = {'$and': [query, {date_column: date if date else {'$in': [None, '']}}]}
+            last_id, replace = None, True
+            while True:  # one batch at a time in '_id' order, only the first replaces the partition
+                page_query = date_query if last_id is None else {'$and': [date_query, {'_id': {'$gt': last_id}}]}
+                batch = list(collection.find(page_query, None).sort('_id', 1).limit(batch_size))
+                if not batch:
+                    break
+                row_count += self.write(kind, batch, symbol, replace=replace)
+                last_id, replace = batch[-1]['_id'], False
+            if date and not filtered:
+                watermark.save(date=date)
+        # a filtered export leaves partial partitions behind, the next unfiltered one has to redo them
+        earliest = next((date for date in dates if date), None)
+        if filtered and saved is not None and earliest and earliest < saved['date']:
+            watermark.save(date=earliest)
+        print(f'{symbol}: 已导出 {row_count} 条 {kind}（{len(dates)} 个日期分区）到 {os.path.join(self.root, kind)}')
+        return row_count
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='从 mongo 导出 Parquet')
+    arg_parser.add_argument('symbols', nargs='+', help='股票代码，例如 000002 600438')
+    arg_parser.add_argument('--kind', choices=['post_info', 'comment_info'], nargs='+',
+                            default=['post_info', 'comment_info'])
+    arg_parser.add_argument('--root', default='parquet')
+    arg_parser.add_argument('--compression', default='zstd')
+    arg_parser.add_argument('--full', action='store_true', help='重新导出所有日期分区，而不是从上次导出的日期开始')
+    args = arg_parser.parse_args()
+
+    exporter = ParquetExporter(args.root, args.compression)
+    for symbol in args.symbols:
+        for kind in args.kind:
+            exporter.export_collection(kind, symbol, full=args.full)
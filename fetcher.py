@@ -0,0 +1,48 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# the same identity the selenium webdriver presents (see 'create_webdriver' in driver_pool.py)
+USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+              'Chrome/111.0.0.0 Safari/537.36')
+HEADERS = {
+    'User-Agent': USER_AGENT,
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+    'Accept-Language': 'zh-CN,zh;q=0.9',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+}
+
+
+class HttpFetcher(object):
+    # a pooled keep-alive session for the server-rendered guba pages, no browser involved
+
+    def __init__(self, pool_size: int = 8, timeout: float = 10):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update(HEADERS)
+
+    def load_browser_cookies(self, browser):
+        # share the cookies of a selenium webdriver, so both backends look like the same visitor
+        for cookie in browser.get_cookies():
+            self.session.cookies.set(cookie['name'], cookie['value'],
+                                     domain=cookie.get('domain'), path=cookie.get('path', '/'))
+
+    def get(self, url: str) -> str:
+        response = self.session.get(url, timeout=self.timeout)  # gzip is decoded by requests itself
+        response.raise_for_status()
+        if response.encoding is None or response.encoding.lower() == 'iso-8859-1':
+            response.encoding = 'utf-8'  # guba pages are utf-8 even when the header does not say so
+        return response.text
+
+    def post_json(self, url: str, data: dict, headers: dict = None):
+        # the json data endpoints the pages themselves call
+        response = self.session.post(url, data=data, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,207 @@
+from datetime import datetime, timedelta
+from itertools import islice
+import argparse
+import heapq
+import math
+import time
+
+from mongodb import MongoAPI
+from crawler import PostCrawler, CommentCrawler
+from metrics import METRICS, SnapshotWriter, snapshot_path
+from reply_api import REPLY_PAGE_SIZE
+
+
+def post_datetime(post):
+    # 'post_date' + 'post_time' of a stored post, the time is missing for some posts
+    return datetime.strptime(f"{post['post_date']} {post.get('post_time') or '00:00'}", '%Y-%m-%d %H:%M')
+
+
+class HotPostScheduler(object):
+    # keeps the comments of the fast-moving threads fresh: every cycle refreshes the first pages of the list
+    # ordered by the last reply (so the active threads are there, old or new), updates the reply velocity
+    # of every recent post from its successive comment_num observations and spends a fixed request budget
+    # on the re-crawls with the most missing replies per request, weighted by velocity and age
+
+    def __init__(self, symbols, budget: int = 200, list_pages: int = 3, max_age_days: int = 30,
+                 half_life_hours: float = 24.0, smoothing: float = 0.5, backend: str = 'api',
+                 list_backend: str = 'http', batch_size: int = 1000):
+        """
+        :param symbols: ['000002', '600438', ...] 股票代码列表，所有股票共用一个优先队列和请求预算
+        :param budget: 每轮补爬评论最多发出的请求数（'api' 方式为回复页数，'browser' 方式为帖子数）
+        :param list_pages: 每轮刷新的按最后回复排列的列表页数（不计入 budget），用来观察 comment_num 的变化
+        :param max_age_days: 只跟踪这么多天内发布的帖子，更早的帖子交给 find_changed 的日常补爬
+        :param half_life_hours: 帖子的权重每过这么多小时减半
+        :param smoothing: 回复速度的指数平滑系数，越大越看重最近一次观察
+        :param backend: 传给 CommentCrawler 的抓取方式
+        :param list_backend: 传给 PostCrawler 的抓取方式
+        :param batch_size: 每次从 mongo 读取的帖子数
+        """
+        self.symbols = list(symbols)
+        self.budget = budget
+        self.list_pages = list_pages
+        self.max_age_days = max_age_days
+        self.half_life_hours = half_life_hours
+        self.smoothing = smoothing
+        self.backend = backend
+        self.list_backend = list_backend
+        self.batch_size = batch_size
+        self.cycle = 0
+        self.collections = {}  # (db_name, collection_name) -> MongoAPI, created once for all the cycles
+
+    def mongo(self, db_name: str, collection_name: str):
+        key = (db_name, collection_name)
+        if key not in self.collections:
+            self.collections[key] = MongoAPI(db_name, collection_name)
+        return self.collections[key]
+
+    def refresh(self, symbol):
+        # the list pages carry the current comment_num, the upsert refreshes it in post_info; the list ordered
+        # by post time would only ever show the newest posts, the active older threads would never be observed
+        try:
+            PostCrawler(symbol, backend=self.list_backend, list_order='reply').crawl_post_info(1, self.list_pages,
+                                                                                             resume=False)
+        except Exception as e:  # observe with what is stored
+            print(f'{symbol}: 刷新列表页失败 {e}')
+
+    def observe(self, symbol, now: datetime):
+        """
+        用这一轮读到的 comment_num 更新每个帖子的回复速度（条/小时），观察记录保存在 crawl_state.hot_{symbol}
+        :return: 有待补爬评论的帖子列表
+        """
+        postdb = self.mongo('post_info', f'post_{symbol}')
+        commentdb = self.mongo('comment_info', f'comment_{symbol}')
+        observationdb = self.mongo('crawl_state', f'hot_{symbol}')
+        query = {'post_date': {'$gte': (now - timedelta(days=self.max_age_days)).strftime('%Y-%m-%d')},
+                 'comment_num': {'$gt': 0}}
+        fields = {'_id': 1, 'post_url': 1, 'comment_num': 1, 'crawled_comment_num': 1, 'post_date': 1, 'post_time': 1}
+        cursor = postdb.find(query, fields).batch_size(self.batch_size)
+        candidates = []
+        while True:
+            batch = list(islice(cursor, self.batch_size))
+            if not batch:
+                break
+            post_ids = [post['_id'] for post in batch]
+            previous = {record['_id']: record for record in observationdb.find({'_id': {'$in': post_ids}}, None)}
+            stored = CommentCrawler.stored_counts(commentdb, post_ids)
+            observations = []
+            for post in batch:
+                age_hours = max((now - post_datetime(post)).total_seconds() / 3600, 1.0)
+                velocity = self.update_velocity(previous.get(post['_id']), post['comment_num'], age_hours, now)
+                observations.append({'_id': post['_id'], 'comment_num': post['comment_num'], 'observed_at': now,
+                                     'velocity': velocity})
+                rows, replies = stored.get(post['_id'], (0, 0))
+                pending = post['comment_num'] - max(rows, post.get('crawled_comment_num') or 0)
+                if pending > 0:
+                    candidates.append({'symbol': symbol, 'post_id': post['_id'], 'post_url': post['post_url'],
+                                       'comment_num': post['comment_num'], 'rows': rows, 'replies': replies,
+                                       'pending': pending, 'velocity': velocity, 'age_hours': age_hours})
+            observationdb.bulk_upsert(observations)
+        return candidates
+
+    def update_velocity(self, previous, comment_num: int, age_hours: float, now: datetime):
+        if previous is None:  # the lifetime average until there is a second observation
+            return comment_num / age_hours
+        # at least a minute apart, so two cycles started back to back do not make a spike
+        hours = max((now - previous['observed_at']).total_seconds() / 3600, 1 / 60)
+        # comment_num only goes down when replies are deleted, that is no activity
+        recent = max(comment_num - previous['comment_num'], 0) / hours
+        return self.smoothing * recent + (1 - self.smoothing) * previous['velocity']
+
+    def cost(self, candidate):
+        # requests of the re-crawl: the reply pages from the last stored one on (see CommentCrawler.first_reply_page)
+        if self.backend != 'api':
+            return 1
+        first_page = max(1, math.ceil(candidate['replies'] / REPLY_PAGE_SIZE))
+        last_page = max(1, math.ceil(candidate['comment_num'] / REPLY_PAGE_SIZE))  # comment_num also counts sub-replies
+        return max(1, last_page - first_page + 1)
+
+    def score(self, candidate):
+        # missing replies per request, more for fast threads, halved every 'half_life_hours' of post age
+        weight = (1 + candidate['velocity']) * 0.5 ** (candidate['age_hours'] / self.half_life_hours)
+        return candidate['pending'] * weight / self.cost(candidate)
+
+    def plan(self, candidates):
+        """
+        :return: 预算内价值最高的补爬，按优先级排列
+        """
+        queue = [(-self.score(candidate), candidate['symbol'], candidate['post_id'], candidate)
+                 for candidate in candidates]
+        heapq.heapify(queue)
+        chosen, remaining = [], self.budget
+        while queue and remaining > 0:
+            _, _, _, candidate = heapq.heappop(queue)
+            cost = self.cost(candidate)
+            if cost > remaining:  # a smaller re-crawl further down may still fit
+                continue
+            chosen.append(candidate)
+            remaining -= cost
+        return chosen, self.budget - remaining
+
+    def crawl(self, symbol, chosen):
+        postdb = self.mongo('post_info', f'post_{symbol}')
+        delta = {candidate['post_id']: {'post_url': candidate['post_url'], 'comment_num': candidate['comment_num'],
+                                        'rows': candidate['rows'], 'replies': candidate['replies']}
+                 for candidate in chosen}
+        crawler = CommentCrawler(symbol, backend=self.backend)
+        crawler.select_changed(postdb, delta, 'hot')
+        crawler.crawl_comment_info(report_path=f'comment_crawl_result_{symbol}_hot.json')
+        return crawler.row_count
+
+    def run_cycle(self):
+        self.cycle += 1
+        start = time.time()
+        candidates = []
+        for symbol in self.symbols:
+            if self.list_pages:
+                self.refresh(symbol)
+            candidates.extend(self.observe(symbol, datetime.now()))
+        chosen, spent = self.plan(candidates)
+        print(f'第 {self.cycle} 轮: {len(candidates)} 个帖子有新评论，补爬其中 {len(chosen)} 个，'
+              f'预计请求 {spent}/{self.budget} 次')
+        for symbol in self.symbols:
+            posts = [candidate for candidate in chosen if candidate['symbol'] == symbol]
+            if not posts:
+                continue
+            try:
+                self.crawl(symbol, posts)
+            except Exception as e:  # one broken symbol must not stop the others
+                print(f'{symbol}: 补爬评论失败 {e}')
+        print(f'第 {self.cycle} 轮完成，花费 {(time.time() - start)/60:.2f} 分钟')
+        return chosen
+
+    def run(self, cycles: int = None, interval: float = 3600):
+        """
+        :param cycles: 运行的轮数，None 表示一直运行
+        :param interval: 两轮开始之间的间隔（秒）
+        """
+        while cycles is None or self.cycle < cycles:
+            start = time.time()
+            self.run_cycle()
+            if cycles is not None and self.cycle >= cycles:
+                break
+            time.sleep(max(0.0, interval - (time.time() - start)))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='热门帖子评论的优先补爬')
+    arg_parser.add_argument('symbols', nargs='+', help='股票代码，例如 000002 600438')
+    arg_parser.add_argument('--budget', type=int, default=200, help='每轮补爬评论的请求数')
+    arg_parser.add_argument('--list-pages', type=int, default=3, help='每轮刷新的列表页数')
+    arg_parser.add_argument('--max-age-days', type=int, default=30)
+    arg_parser.add_argument('--half-life-hours', type=float, default=24.0)
+    arg_parser.add_argument('--interval', type=float, default=3600, help='每轮间隔（秒）')
+    arg_parser.add_argument('--cycles', type=int, default=None)
+    arg_parser.add_argument('--backend', choices=['browser', 'api'], default='api')
+    arg_parser.add_argument('--list-backend', choices=['browser', 'http'], default='http')
+    arg_parser.add_argument('--metrics-port', type=int, default=None, help='prometheus 指标端口')
+    arg_parser.add_argument('--metrics-dir', default=None, help='指标快照目录，例如 metrics')
+    args = arg_parser.parse_args()
+
+    if args.metrics_port is not None:
+        METRICS.serve(args.metrics_port)
+    if args.metrics_dir is not None:
+        SnapshotWriter(METRICS, snapshot_path(args.metrics_dir)).start()
+
+    scheduler = HotPostScheduler(args.symbols, args.budget, args.list_pages, args.max_age_days,
+                                 args.half_life_hours, backend=args.backend, list_backend=args.list_backend)
+    scheduler.run(args.cycles, args.interval)
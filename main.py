@@ -11,24 +11,114 @@ import re
 from datetime import datetime
 from urllib.parse import urljoin
 
-from playwright.async_api import async_playwright
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 from apify import Actor
 
+from page_pool import PagePool, memory_bound_concurrency
+from rate_limiter import AdaptiveRateLimiter, expected_title
+from resource_blocker import ResourceBlocker
+from readiness import ReadinessWaiter
+from dataset_writer import DatasetWriter
+from seen_filter import BloomFilter
+from metrics import METRICS
+
+
+# 帖子列表和评论的候选选择器，按顺序尝试；帖子列表的就绪也以它们为准
+POST_LIST_SELECTORS = [
+    'tr.listitem',
+    'tr[class*="listitem"]',
+    '.articleh',
+    '.normal_post',
+    'tbody tr'
+]
+COMMENT_SELECTORS = [
+    '.reply-item',
+    '.comment-item',
+    '.stock-comment',
+    '[class*="comment"]',
+    '[class*="reply"]'
+]
+# 评论就绪只等具体的评论条目：'[class*="comment"]' 这类兜底选择器在评论框、按钮上就会命中，评论还没渲染就返回了
+COMMENT_READY_SELECTORS = [
+    'div.reply_item',
+    '.reply-item',
+    '.comment-item',
+    '.stock-comment'
+]
+
+GUBA_URL = 'https://guba.eastmoney.com'
+
+# 跨运行保存已爬评论帖子的 Bloom filter（命名存储不会随单次运行删除）
+SEEN_STORE_NAME = 'eastmoney-seen-posts'
+
+
+def parse_post_id(post_url):
+    """帖子链接中的 id，例如 news,002001,1234567890.html"""
+    match = re.search(r',(\d+)\.html', post_url or '')
+    return int(match.group(1)) if match else None
+
 
 class EastMoneyCrawler:
     """东方财富股吧爬虫"""
 
-    def __init__(self, stock_code, stock_name, max_posts=10, headless=True):
+    def __init__(self, stock_code, stock_name, output, max_posts=10, headless=True, limiter=None, blocker=None,
+                 ready_timeout=10, seen=None, guba_url=GUBA_URL):
         self.stock_code = stock_code
         self.stock_name = stock_name
         self.max_posts = max_posts
         self.headless = headless
-        self.base_url = f"https://guba.eastmoney.com/list,{stock_code}.html"
+        # 股吧地址，基准测试时指向本地提供录制页面的服务器
+        self.guba_url = guba_url
+        self.base_url = f"{guba_url}/list,{stock_code}.html"
         self.logger = logging.getLogger(__name__)
-
-        # 存储数据
-        self.posts_data = []
-        self.comments_data = []
+        # 按域名自适应调整请求速率，并发的评论页面共用
+        self.limiter = limiter or AdaptiveRateLimiter()
+        # 页面池注册的请求拦截器，用于记录每个页面节省的请求
+        self.blocker = blocker
+        # 等待解析所需的元素出现，代替固定的 sleep
+        self.readiness = ReadinessWaiter(timeout=ready_timeout, labels={'symbol': stock_code, 'backend': 'playwright'})
+
+        # 记录解析后立即交给 DatasetWriter，内存中只保留评论阶段需要的帖子链接
+        self.output = output
+        self.post_urls = []
+        self.post_count = 0
+        self.comment_count = 0
+        # 之前运行已爬过评论的帖子（BloomFilter），打开页面之前先查
+        self.seen = seen
+        self.skipped_posts = 0
+
+    async def goto(self, page, url):
+        """限速后访问页面，超时作为限流信号"""
+        await self.limiter.wait_async(url)
+        try:
+            with METRICS.timer('navigation', symbol=self.stock_code, backend='playwright'):
+                await page.goto(url, wait_until='domcontentloaded', timeout=45000)
+        except PlaywrightTimeoutError:
+            self.limiter.throttled(url, 'timeout')
+            raise
+
+    async def emit_post(self, post_data):
+        """帖子直接写入数据集，只留下链接供评论阶段使用"""
+        await self.output.add(post_data)
+        self.post_count += 1
+        if post_data['post_url']:
+            self.post_urls.append(post_data['post_url'])
+
+    async def emit_comment(self, comment_data):
+        await self.output.add(comment_data)
+        self.comment_count += 1
+
+    def log_blocked(self, page, url):
+        if self.blocker is not None:
+            self.blocker.log_page(page, url)
+
+    def check_title(self, url, title):
+        """标题异常（验证页、错误页）时降低速率"""
+        if expected_title(title):
+            return True
+        self.logger.warning(f"页面标题异常: {title}，当前速率 {self.limiter.rate(url):.2f} 页/秒")
+        self.limiter.throttled(url, 'title')
+        return False
 
     async def crawl_post_list(self, page):
         """爬取帖子列表"""
@@ -36,31 +126,20 @@ class EastMoneyCrawler:
             self.logger.info(f"开始爬取股票 {self.stock_name}({self.stock_code}) 的帖子...")
 
             # 访问页面
-            await page.goto(self.base_url, wait_until='domcontentloaded', timeout=45000)
-            await asyncio.sleep(3)
+            await self.goto(page, self.base_url)
 
             # 检查页面是否正确加载
             title = await page.title()
-            if title and ("东方财富" in title or "股吧" in title):
-                self.logger.info(f"✅ 页面加载成功: {title}")
-            else:
-                self.logger.warning(f"页面标题异常: {title}")
+            if not self.check_title(self.base_url, title):
                 return 0
+            self.logger.info(f"✅ 页面加载成功: {title}")
 
-            # 等待页面完全加载
-            await asyncio.sleep(3)
+            # 等待帖子列表出现，超过上限时按原逻辑继续（正则兜底）
+            await self.readiness.wait_page(page, POST_LIST_SELECTORS, 'post_list')
 
             # 尝试多种选择器来找到帖子列表
-            selectors = [
-                'tr.listitem',
-                'tr[class*="listitem"]',
-                '.articleh',
-                '.normal_post',
-                'tbody tr'
-            ]
-
             post_elements = []
-            for selector in selectors:
+            for selector in POST_LIST_SELECTORS:
                 try:
                     elements = await page.query_selector_all(selector)
                     if elements:
@@ -71,6 +150,14 @@ class EastMoneyCrawler:
                     self.logger.debug(f"选择器 '{selector}' 失败: {e}")
                     continue
 
+            self.log_blocked(page, self.base_url)
+
+            # 没有 .listitem 的列表页通常意味着被限制访问
+            if post_elements:
+                self.limiter.success(self.base_url)
+            else:
+                self.limiter.throttled(self.base_url, 'empty')
+
             if not post_elements:
                 self.logger.warning("未找到帖子元素，尝试获取页面内容进行分析")
 
@@ -86,7 +173,7 @@ class EastMoneyCrawler:
                 count = 0
                 for title, href, text in matches[:self.max_posts]:
                     if self.stock_code in href or "guba.eastmoney.com" in href:
-                        post_url = href if href.startswith('http') else f"https://guba.eastmoney.com{href}"
+                        post_url = href if href.startswith('http') else f"{self.guba_url}{href}"
 
                         post_data = {
                             'title': title or text,
@@ -100,11 +187,11 @@ class EastMoneyCrawler:
                             'crawl_time': datetime.now().isoformat()
                         }
 
-                        self.posts_data.append(post_data)
+                        await self.emit_post(post_data)
                         count += 1
                         self.logger.info(f"帖子 {count}: {title[:50]}...")
 
-                return len(self.posts_data)
+                return self.post_count
 
             # 处理找到的帖子元素
             for i, element in enumerate(post_elements[:self.max_posts]):
@@ -120,7 +207,7 @@ class EastMoneyCrawler:
                             title = await title_element.inner_text()
 
                         href = await title_element.get_attribute('href')
-                        post_url = href if href and href.startswith('http') else f"https://guba.eastmoney.com{href}" if href else ""
+                        post_url = href if href and href.startswith('http') else f"{self.guba_url}{href}" if href else ""
                     else:
                         title = f"帖子{i+1}"
                         post_url = ""
@@ -146,14 +233,14 @@ class EastMoneyCrawler:
                         'crawl_time': datetime.now().isoformat()
                     }
 
-                    self.posts_data.append(post_data)
+                    await self.emit_post(post_data)
                     self.logger.info(f"帖子 {i+1}: {post_data['title'][:50]}...")
 
                 except Exception as e:
                     self.logger.error(f"处理帖子 {i+1} 时出错: {e}")
                     continue
 
-            return len(self.posts_data)
+            return self.post_count
 
         except Exception as e:
             self.logger.error(f"爬取帖子失败: {e}")
@@ -161,23 +248,26 @@ class EastMoneyCrawler:
 
     async def crawl_comments(self, page, post_url, max_comments=5):
         """爬取单个帖子的评论"""
+        post_id = parse_post_id(post_url)
+        if self.seen is not None and post_id in self.seen:
+            self.logger.info(f"之前已爬过评论，跳过: {post_url}")
+            self.skipped_posts += 1
+            return 0
         try:
             self.logger.info(f"正在爬取帖子评论: {post_url}")
 
-            await page.goto(post_url, wait_until='domcontentloaded', timeout=45000)
-            await asyncio.sleep(3)
+            await self.goto(page, post_url)
 
-            # 尝试多种选择器来找到评论
-            comment_selectors = [
-                '.reply-item',
-                '.comment-item',
-                '.stock-comment',
-                '[class*="comment"]',
-                '[class*="reply"]'
-            ]
+            if not self.check_title(post_url, await page.title()):
+                return 0
+            self.limiter.success(post_url)
 
+            # 评论由脚本渲染，等待其出现；没有评论的帖子会等到上限
+            await self.readiness.wait_page(page, COMMENT_READY_SELECTORS, 'comment')
+
+            # 尝试多种选择器来找到评论
             comment_elements = []
-            for selector in comment_selectors:
+            for selector in COMMENT_SELECTORS:
                 try:
                     elements = await page.query_selector_all(selector)
                     if elements:
@@ -187,6 +277,9 @@ class EastMoneyCrawler:
                 except:
                     continue
 
+            self.log_blocked(page, post_url)
+
+            stored = 0
             for i, element in enumerate(comment_elements[:max_comments]):
                 try:
                     # 提取评论内容
@@ -202,12 +295,16 @@ class EastMoneyCrawler:
                         'crawl_time': datetime.now().isoformat()
                     }
 
-                    self.comments_data.append(comment_data)
+                    await self.emit_comment(comment_data)
+                    stored += 1
 
                 except Exception as e:
                     self.logger.error(f"处理评论 {i+1} 时出错: {e}")
                     continue
 
+            # 只记住评论都已保存的帖子；没找到评论可能只是还没渲染出来，下次运行再试
+            if self.seen is not None and post_id is not None and 0 < stored == len(comment_elements[:max_comments]):
+                self.seen.add(post_id)
             return len(comment_elements[:max_comments])
 
         except Exception as e:
@@ -227,76 +324,112 @@ async def main() -> None:
         stock_name = actor_input.get('stockName', '新和成')
         max_posts = actor_input.get('maxPosts', 10)
         crawl_comments = actor_input.get('crawlComments', False)
+        max_comment_posts = actor_input.get('maxCommentPosts', max_posts)
+        concurrency = memory_bound_concurrency(actor_input.get('commentConcurrency', 3))
+        block_resources = actor_input.get('blockResources', True)
+        ready_timeout = actor_input.get('readyTimeout', 10)
+        push_batch_size = actor_input.get('pushBatchSize', 50)
+        skip_seen_posts = actor_input.get('skipSeenPosts', False)
         headless = actor_input.get('headless', True)
 
         Actor.log.info(f"输入参数: 股票代码={stock_code}, 股票名称={stock_name}, 最大帖子数={max_posts}")
-        Actor.log.info(f"爬取评论: {crawl_comments}, 无头模式: {headless}")
+        Actor.log.info(f"爬取评论: {crawl_comments}, 评论帖子数: {max_comment_posts}, 并发数: {concurrency}, "
+                       f"屏蔽资源: {block_resources}, 无头模式: {headless}")
+
+        # 屏蔽图片、字体、样式表和广告统计脚本，解析只需要文本
+        blocker = ResourceBlocker() if block_resources else None
+
+        # 之前运行已爬过评论的帖子，按股票代码保存在命名的 key-value store 中
+        seen, seen_store, seen_key = None, None, f'SEEN_POSTS_{stock_code}'
+        if skip_seen_posts and crawl_comments:
+            seen_store = await Actor.open_key_value_store(name=SEEN_STORE_NAME)
+            data = await seen_store.get_value(seen_key)
+            seen = BloomFilter.from_bytes(data) if data else BloomFilter()
+
+        # 帖子和评论解析后按批推送到数据集，运行结束或出错退出时推送剩余部分
+        output = DatasetWriter(Actor.push_data, batch_size=push_batch_size)
 
         # 创建爬虫实例
         crawler = EastMoneyCrawler(
             stock_code=stock_code,
             stock_name=stock_name,
+            output=output,
             max_posts=max_posts,
-            headless=headless
+            headless=headless,
+            blocker=blocker,
+            ready_timeout=ready_timeout,
+            seen=seen
         )
 
-        # 启动 Playwright
-        Actor.log.info("正在启动 Playwright 浏览器...")
-
-        async with async_playwright() as playwright:
-            browser = await playwright.chromium.launch(
-                headless=headless,
-                args=[
-                    '--no-sandbox',
-                    '--disable-setuid-sandbox',
-                    '--disable-dev-shm-usage',
-                    '--disable-blink-features=AutomationControlled',
-                    '--disable-web-security',
-                    '--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-                ]
-            )
-
-            context = await browser.new_context()
-            page = await context.new_page()
-
-            # 设置超时时间
-            page.set_default_timeout(60000)
-            page.set_default_navigation_timeout(60000)
-
-            Actor.log.info("✅ Playwright 浏览器初始化成功")
-
-            # 爬取帖子列表
-            posts_count = await crawler.crawl_post_list(page)
-            Actor.log.info(f"✅ 成功爬取 {posts_count} 个帖子")
-
-            # 将帖子数据推送到 Apify 数据集
-            if crawler.posts_data:
-                await Actor.push_data(crawler.posts_data)
-                Actor.log.info(f"✅ 已将 {len(crawler.posts_data)} 个帖子推送到数据集")
-
-            # 如果需要爬取评论
-            if crawl_comments and crawler.posts_data:
-                Actor.log.info("开始爬取帖子评论...")
-
-                for i, post in enumerate(crawler.posts_data[:5]):  # 限制只爬取前5个帖子的评论
-                    if post.get('post_url'):
-                        Actor.log.info(f"爬取第 {i+1}/{min(5, len(crawler.posts_data))} 个帖子的评论")
-                        comments_count = await crawler.crawl_comments(page, post['post_url'])
-                        Actor.log.info(f"找到 {comments_count} 条评论")
-                        await asyncio.sleep(2)  # 避免请求过快
-
-                # 将评论数据推送到 Apify 数据集
-                if crawler.comments_data:
-                    await Actor.push_data(crawler.comments_data)
-                    Actor.log.info(f"✅ 已将 {len(crawler.comments_data)} 条评论推送到数据集")
-
-            # 关闭浏览器
-            await browser.close()
+        async with output:
+            # 启动 Playwright
+            Actor.log.info("正在启动 Playwright 浏览器...")
+
+            async with async_playwright() as playwright:
+                browser = await playwright.chromium.launch(
+                    headless=headless,
+                    args=[
+                        '--no-sandbox',
+                        '--disable-setuid-sandbox',
+                        '--disable-dev-shm-usage',
+                        '--disable-blink-features=AutomationControlled',
+                        '--disable-web-security',
+                        '--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+                    ]
+                )
+
+                # 复用的浏览器上下文池，评论并发爬取时从中借出页面
+                pool = PagePool(browser, size=concurrency, timeout=60000, blocker=blocker)
+                await pool.start()
+
+                Actor.log.info("✅ Playwright 浏览器初始化成功")
+
+                # 爬取帖子列表
+                async with pool.page() as page:
+                    posts_count = await crawler.crawl_post_list(page)
+                Actor.log.info(f"✅ 成功爬取 {posts_count} 个帖子")
+
+                # 如果需要爬取评论
+                if crawl_comments and crawler.post_urls:
+                    Actor.log.info("开始爬取帖子评论...")
+
+                    post_urls = crawler.post_urls[:max_comment_posts]
+
+                    async def crawl_post_comments(i, post_url):
+                        async with pool.page() as page:  # 池的大小即并发上限
+                            Actor.log.info(f"爬取第 {i+1}/{len(post_urls)} 个帖子的评论")
+                            comments_count = await crawler.crawl_comments(page, post_url)
+                            Actor.log.info(f"找到 {comments_count} 条评论")
+
+                    await asyncio.gather(*(crawl_post_comments(i, url) for i, url in enumerate(post_urls)))
+
+                # 关闭浏览器
+                await pool.close()
+                await browser.close()
+
+        if seen is not None:
+            # 合并期间其他运行保存的内容后再写回
+            data = await seen_store.get_value(seen_key)
+            if data:
+                seen.merge(BloomFilter.from_bytes(data))
+            await seen_store.set_value(seen_key, seen.to_bytes(), content_type='application/octet-stream')
 
         # 输出统计信息
         Actor.log.info("=== 爬取完成 ===")
-        Actor.log.info(f"总帖子数: {len(crawler.posts_data)}")
-        Actor.log.info(f"总评论数: {len(crawler.comments_data)}")
+        for host, stats in crawler.limiter.stats().items():
+            Actor.log.info(f"{host}: 最终速率 {stats['rate']:.2f} 页/秒, 请求 {stats['requests']} 次, "
+                           f"限流信号 {stats['throttles']}")
+        for line in crawler.readiness.describe():
+            Actor.log.info(line)
+        if blocker is not None:
+            Actor.log.info(f"共屏蔽 {blocker.total['requests']} 个请求，约节省 {blocker.total['bytes'] / 1024 / 1024:.1f} MB")
+        Actor.log.info(f"总帖子数: {crawler.post_count}")
+        Actor.log.info(f"总评论数: {crawler.comment_count}")
+        if seen is not None:
+            Actor.log.info(f"跳过之前已爬过评论的帖子: {crawler.skipped_posts} 个")
+        Actor.log.info(f"数据集: 推送 {output.batches} 批，共 {output.pushed} 条记录")
+        # 各阶段的计数和耗时分布，保存在默认 key-value store 的 METRICS 中
+        await Actor.set_value('METRICS', METRICS.snapshot())
         Actor.log.info("🎉 任务完成！")
 
 
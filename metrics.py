@@ -0,0 +1,238 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import glob
+import json
+import os
+import threading
+import time
+
+
+# upper bounds (seconds) of the latency histograms, from a parse of one page to a browser restart
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    'guba_stage_seconds': 'Latency of one crawl stage: navigation, readiness, parse, db_insert, browser_restart',
+    'guba_stage_errors_total': 'Crawl stages that raised',
+    'guba_readiness_timeouts_total': 'Pages whose parsed elements did not appear in time',
+    'guba_retries_total': 'Pages or posts retried after an error',
+    'guba_browser_restarts_total': 'Browser sessions reset or replaced after an error',
+    'guba_browser_sessions_total': 'Chrome sessions started and quit by the driver pool',
+    'guba_throttled_total': 'Rate limiter slow downs per host and reason',
+    'guba_pages_total': 'List pages and posts finished',
+    'guba_rows_total': 'Posts and comments parsed',
+}
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items() if value is not None))
+
+
+def escape(value: str):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metrics(object):
+    # counters and latency histograms of the crawl stages, labeled by stage / symbol / backend,
+    # read as prometheus text (serve) or as a json snapshot (write_snapshot, SnapshotWriter)
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: 直方图各桶的上限（秒）
+        """
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> {'buckets': [count per bucket, +Inf last], 'sum', 'count'}
+        self.start = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, label_key(labels))
+        index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        # guba_stage_seconds of one stage, an exception is also counted in guba_stage_errors_total
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc('guba_stage_errors_total', stage=stage, **labels)
+            raise
+        finally:
+            self.observe('guba_stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative, total = [], 0
+                for bound, count in zip(self.buckets + ('+Inf',), histogram['buckets']):
+                    total += count
+                    cumulative.append([bound, total])
+                histograms.append({'name': name, 'labels': dict(labels), 'buckets': cumulative,
+                                   'sum': histogram['sum'], 'count': histogram['count'],
+                                   'avg': histogram['sum'] / histogram['count'] if histogram['count'] else 0.0})
+        return {'timestamp': time.time(), 'uptime_seconds': time.time() - self.start, 'pid': os.getpid(),
+                'counters': counters, 'histograms': histograms}
+
+    def merge_snapshot(self, snapshot):
+        # adds the values of another process' snapshot, e.g. a scheduler worker
+        with self.lock:
+            for counter in snapshot['counters']:
+                key = (counter['name'], label_key(counter['labels']))
+                self.counters[key] = self.counters.get(key, 0) + counter['value']
+            for item in snapshot['histograms']:
+                key = (item['name'], label_key(item['labels']))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0,
+                                                        'count': 0}
+                previous = 0
+                for index, (_, total) in enumerate(item['buckets']):  # back from cumulative
+                    histogram['buckets'][index] += total - previous
+                    previous = total
+                histogram['sum'] += item['sum']
+                histogram['count'] += item['count']
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines, described = [], set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for counter in snapshot['counters']:
+            describe(counter['name'], 'counter')
+            lines.append(f"{counter['name']}{format_labels(sorted(counter['labels'].items()))} {counter['value']}")
+        for item in snapshot['histograms']:
+            name, labels = item['name'], sorted(item['labels'].items())
+            describe(name, 'histogram')
+            for bound, total in item['buckets']:
+                lines.append(f'{name}_bucket{format_labels(labels, [("le", str(bound))])} {total}')
+            lines.append(f'{name}_sum{format_labels(labels)} {item["sum"]}')
+            lines.append(f'{name}_count{format_labels(labels)} {item["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_snapshot(self, path: str):
+        # replaced atomically, a reader never sees half a file
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def collect(self, snapshot_dir: str = None):
+        # this process, plus the snapshots other processes write to 'snapshot_dir'
+        if snapshot_dir is None:
+            return self
+        merged = Metrics(self.buckets)
+        merged.start = self.start
+        merged.merge_snapshot(self.snapshot())
+        for path in glob.glob(os.path.join(snapshot_dir, 'metrics_*.json')):
+            if path == os.path.join(snapshot_dir, f'metrics_{os.getpid()}.json'):
+                continue  # already counted above
+            try:
+                with open(path, encoding='utf-8') as f:
+                    merged.merge_snapshot(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f'读取指标快照 {path} 失败 {e}')
+        return merged
+
+    def serve(self, port: int = 9108, host: str = '0.0.0.0', snapshot_dir: str = None):
+        """
+        在后台线程提供 /metrics（prometheus 文本格式）和 /metrics.json（快照）
+        :param snapshot_dir: 同时汇总该目录下其他进程写入的快照（例如调度器的工作进程）
+        :return: HTTP server，调用 shutdown() 停止
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                collected = metrics.collect(snapshot_dir)
+                if self.path.split('?')[0] == '/metrics':
+                    body, content_type = collected.to_prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+                elif self.path.split('?')[0] == '/metrics.json':
+                    body, content_type = json.dumps(collected.snapshot()).encode('utf-8'), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # scraped every few seconds, keep the crawl output readable
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f'指标地址 http://{host}:{server.server_port}/metrics')
+        return server
+
+
+class SnapshotWriter(object):
+    # writes the json snapshot every 'interval' seconds from a background thread, and once more on stop
+
+    def __init__(self, metrics: Metrics, path: str, interval: float = 30.0):
+        """
+        :param path: 快照文件路径，多个进程写同一目录时用 metrics_{pid}.json
+        :param interval: 写入间隔（秒）
+        """
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            self.metrics.write_snapshot(self.path)
+        except OSError as e:  # the crawl goes on without telemetry
+            print(f'写入指标快照失败 {e}')
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+
+def snapshot_path(snapshot_dir: str):
+    return os.path.join(snapshot_dir, f'metrics_{os.getpid()}.json')
+
+
+# one registry per process, like the rate limiter
+METRICS = Metrics()
@@ -1,16 +1,71 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+import os
+import queue
+import threading
+import time
+
+from metrics import METRICS
+
+
+# the secondary indexes every collection of a database needs (post_{symbol} / comment_{symbol})
+INDEXES = {
+    'post_info': [[('post_date', 1), ('comment_num', 1)]],  # CommentCrawler.find_by_date, ParquetExporter
+    'comment_info': [[('post_id', 1)], [('comment_date', 1), ('_id', 1)]],  # comments of one post, ParquetExporter
+}
 
 
 class MongoAPI(object):
 
+    ensured = set()  # collections whose indexes were already ensured by this process
+    clients = {}  # (pid, host, port) -> MongoClient, shared by every MongoAPI of the process
+    clients_lock = threading.Lock()
+
     def __init__(self, db_name: str, collection_name: str, host='localhost', port=27017):
         self.host = host
         self.port = port
         self.db_name = db_name
         self.collection = collection_name
-        self.client = MongoClient(host=self.host, port=self.port)
+        self.client = self.shared_client(host, port)
         self.database = self.client[self.db_name]
         self.collection = self.database[self.collection]
+        self.ensure_indexes()
+
+    @staticmethod
+    def shared_client(host, port):
+        # a MongoClient is a thread-safe connection pool, one per server is enough for long-running schedulers
+        # that keep creating crawlers; keyed on the pid too, a client must not be used across a fork
+        key = (os.getpid(), host, port)
+        with MongoAPI.clients_lock:
+            client = MongoAPI.clients.get(key)
+            if client is None:
+                client = MongoAPI.clients[key] = MongoClient(host=host, port=port)
+        return client
+
+    def ensure_indexes(self):
+        key = (self.host, self.port, self.db_name, self.collection.name)
+        if key in MongoAPI.ensured:  # create_index is idempotent, but still a round trip
+            return
+        for keys in INDEXES.get(self.db_name, []):
+            self.collection.create_index(keys)
+        MongoAPI.ensured.add(key)
+
+    def index_usage(self):
+        # how many operations used each index since mongod started
+        return [{'name': stats['name'], 'key': stats['key'], 'ops': stats['accesses']['ops']}
+                for stats in self.collection.aggregate([{'$indexStats': {}}])]
+
+    def query_plan(self, query, sort=None):
+        # the winning plan stages of a query, e.g. ['FETCH', 'IXSCAN'] or ['COLLSCAN']
+        cursor = self.collection.find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        plan = plan.get('queryPlan', plan)  # the slot based engine nests the classic plan
+        stages = []
+        while plan:
+            stages.append(plan['stage'])
+            plan = plan.get('inputStage')
+        return stages
 
     def insert_one(self, kv_dict):
         self.collection.insert_one(kv_dict)
@@ -18,6 +73,13 @@ class MongoAPI(object):
     def insert_many(self, li_dict):  # more efficient
         self.collection.insert_many(li_dict)
 
+    def bulk_upsert(self, li_dict):  # one unordered round trip keyed on '_id', safe to repeat
+        if not li_dict:
+            return None
+        requests = [UpdateOne({'_id': kv_dict['_id']}, {'$set': {k: v for k, v in kv_dict.items() if k != '_id'}},
+                              upsert=True) for kv_dict in li_dict]
+        return self.collection.bulk_write(requests, ordered=False)
+
     def find_one(self, query1, query2):
         return self.collection.find_one(query1, query2)
 
@@ -30,11 +92,138 @@ class MongoAPI(object):
     def find_last(self):
         return self.collection.find_one(sort=[('_id', -1)])
 
-    def count_documents(self):
-        return self.collection.count_documents({})
+    def count_documents(self, query: dict = None):
+        return self.collection.count_documents(query or {})
+
+    def aggregate(self, pipeline):
+        return self.collection.aggregate(pipeline)
 
     def update_one(self, kv_dict):
         self.collection.update_one(kv_dict, {'$set': kv_dict}, upsert=True)
 
+    def upsert_one(self, query, kv_dict):
+        self.collection.update_one(query, {'$set': kv_dict}, upsert=True)
+
+    def delete_one(self, query):
+        self.collection.delete_one(query)
+
     def drop(self):
         self.collection.drop()
+
+
+class SinkError(Exception):
+    # a batch could not be written; nothing after it is written either, so the crawl has to stop
+    # (its checkpoint stays at the last written batch and a resumed run starts from there)
+    pass
+
+
+class BufferedMongoSink(object):
+    # write-behind buffer: documents of many pages are upserted from a background thread,
+    # so fetching and parsing the next page overlaps with the mongo write of the previous one
+
+    def __init__(self, mongo: MongoAPI, batch_size: int = 500, max_age: float = 2.0, max_pending: int = 8,
+                 labels: dict = None):
+        """
+        :param batch_size: 缓冲的文档数达到该值就写入
+        :param max_age: 缓冲中最早的文档等待超过该秒数也写入
+        :param max_pending: 等待写入的批次上限，写满后 put_many 会阻塞（背压）
+        :param labels: 指标标签，例如 {'symbol': '000002', 'backend': 'browser'}
+        """
+        self.mongo = mongo
+        self.labels = labels or {}
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.callbacks = []  # called once the documents put before them are written
+        self.buffer_start = None
+        self.error = None
+        self.closed = False
+
+        self.flush_count = 0
+        self.doc_count = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()  # flush whatever is buffered, also when the crawl raised
+
+    def put_many(self, li_dict, on_flushed=None):
+        self.raise_error()
+        with self.lock:
+            self.buffer.extend(li_dict)
+            if on_flushed is not None:
+                self.callbacks.append(on_flushed)
+            if self.buffer_start is None:
+                self.buffer_start = time.time()
+            if len(self.buffer) >= self.batch_size:
+                self.enqueue()
+
+    def flush(self):
+        with self.lock:
+            self.enqueue()
+
+    def enqueue(self):  # the caller holds the lock, so batches keep their order
+        if self.buffer or self.callbacks:
+            self.queue.put((self.buffer, self.callbacks))  # blocks while the writer is behind
+            self.buffer, self.callbacks, self.buffer_start = [], [], None
+
+    def write_loop(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.max_age)
+            except queue.Empty:
+                with self.lock:  # nothing queued, write the buffer if it is too old
+                    if self.buffer_start is None or time.time() - self.buffer_start < self.max_age:
+                        continue
+                    item = (self.buffer, self.callbacks)
+                    self.buffer, self.callbacks, self.buffer_start = [], [], None
+            if item is None:
+                return
+            self.write(*item)
+
+    def write(self, batch, callbacks):
+        if self.error is not None:  # do not write past a failed batch, 'raise_error' reports it
+            return
+        start = time.time()
+        try:
+            with METRICS.timer('db_insert', **self.labels):
+                self.mongo.bulk_upsert(batch)
+            for callback in callbacks:
+                callback()
+        except Exception as e:
+            self.error = e
+            return
+        cost = time.time() - start
+        self.flush_count += 1
+        self.doc_count += len(batch)
+        self.flush_seconds += cost
+        self.max_flush_seconds = max(self.max_flush_seconds, cost)
+
+    def raise_error(self):
+        if self.error is not None:
+            raise SinkError(f'写入 mongo 失败 {self.error}') from self.error
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.flush()
+            self.queue.put(None)
+            self.writer.join()
+        self.raise_error()
+
+    def stats(self):
+        return {
+            'flushes': self.flush_count,
+            'documents': self.doc_count,
+            'avg_flush_seconds': self.flush_seconds / self.flush_count if self.flush_count else 0.0,
+            'max_flush_seconds': self.max_flush_seconds,
+            'pending_batches': self.queue.qsize(),
+        }
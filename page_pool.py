@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Playwright 浏览器上下文池
+固定数量的 context/page 被反复借出和归还，避免为每个帖子重新创建
+"""
+
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+
+# 单个 context（含一个页面）在股吧页面上的大致内存占用，以及浏览器本身需要保留的内存
+CONTEXT_MEMORY_MB = 256
+RESERVED_MEMORY_MB = 512
+
+
+def memory_bound_concurrency(requested, memory_mb=None):
+    """根据 Actor 的内存上限限制并发的 context 数量"""
+    if memory_mb is None:
+        memory_mb = int(os.environ.get('ACTOR_MEMORY_MBYTES', 2048))
+    return max(1, min(requested, (memory_mb - RESERVED_MEMORY_MB) // CONTEXT_MEMORY_MB))
+
+
+class PagePool:
+    """有界的 Playwright 页面池"""
+
+    def __init__(self, browser, size=3, timeout=60000, blocker=None):
+        self.browser = browser
+        self.size = size
+        self.timeout = timeout
+        self.blocker = blocker  # ResourceBlocker，为 None 时不拦截请求
+        self.logger = logging.getLogger(__name__)
+
+        self.contexts = []
+        self.idle = asyncio.Queue()
+
+    async def new_page(self, context):
+        """在 context 中创建页面并设置超时时间"""
+        page = await context.new_page()
+        page.set_default_timeout(self.timeout)
+        page.set_default_navigation_timeout(self.timeout)
+        if self.blocker is not None:
+            await self.blocker.attach(page)
+        return page
+
+    async def start(self):
+        """预先创建全部 context，之后只复用不重建"""
+        for _ in range(self.size):
+            context = await self.browser.new_context()
+            self.contexts.append(context)
+            self.idle.put_nowait((context, await self.new_page(context)))
+        self.logger.info(f"✅ 已创建 {self.size} 个浏览器上下文")
+
+    @asynccontextmanager
+    async def page(self):
+        """借出一个页面，用完自动归还；页面崩溃时在同一个 context 中补一个新页面"""
+        context, page = await self.idle.get()
+        try:
+            yield page
+        finally:
+            if page.is_closed():
+                self.logger.warning("页面已关闭，重新创建")
+                if self.blocker is not None:
+                    self.blocker.detach(page)
+                page = await self.new_page(context)
+            self.idle.put_nowait((context, page))
+
+    async def close(self):
+        """关闭全部 context"""
+        for context in self.contexts:
+            await context.close()
+        self.contexts.clear()
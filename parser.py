@@ -1,15 +1,56 @@
 from selenium.webdriver.common.by import By
-from selenium import webdriver
-from datetime import datetime
+from lxml import html as lxml_html
+from lxml.cssselect import CSSSelector
+from urllib.parse import urljoin
+import hashlib
 import re
 
+from year_resolver import PostYearResolver
+
+
+# compiled once and shared by every page_source snapshot (same selectors as the WebDriver parsers)
+POST_SELECTORS = {
+    'row': CSSSelector('.listitem'),
+    'title': CSSSelector('td:nth-child(3) > div'),
+    'view': CSSSelector('td > div'),
+    'comment_num': CSSSelector('td:nth-child(2) > div'),
+    'url': CSSSelector('td:nth-child(3) > div > a'),
+    'judge': CSSSelector('td:nth-child(3) > div > span'),
+    'date': CSSSelector('div.update.pub_time'),
+    'author': CSSSelector('td:nth-child(4) > div'),
+    'page_num': CSSSelector('ul.paging > li:nth-child(7) > a > span'),
+}
+
+COMMENT_SELECTORS = {
+    'row': CSSSelector('div.allReplyList > div.replylist_content > div.reply_item.cl'),
+    'sub_judge': CSSSelector('ul.replyListL2'),
+    'sub_row': CSSSelector('li.reply_item_l2'),
+    'content': CSSSelector('div.recont_right.fl > div.reply_title > span'),
+    'sub_content': CSSSelector('div.reply_title > span'),
+    'like': CSSSelector('ul.bottomright > li:nth-child(4) > span'),
+    'sub_like': CSSSelector('span.likemodule'),
+    'date': CSSSelector('div.publishtime > span.pubtime'),
+    'sub_date': CSSSelector('span.pubtime'),
+}
+
+
+def node_text(node):
+    # the same whitespace-collapsed text that WebDriver's '.text' returns
+    return ' '.join(node.text_content().split())
+
+
+def first_text(selector, node):
+    found = selector(node)
+    if not found:  # behave like 'find_element' which raises when nothing matches
+        raise ValueError(f'no element matches {selector.css!r}')
+    return node_text(found[0])
+
 
 class PostParser(object):
 
-    def __init__(self):
-        self.year = None
-        self.month = 13
-        self.id = 0
+    def __init__(self, year_resolver: PostYearResolver = None):
+        # no year/month state of its own: any page can be parsed alone, in any order or thread
+        self.year_resolver = year_resolver or PostYearResolver()
 
     @staticmethod
     def parse_post_title(html):
@@ -22,43 +63,34 @@ class PostParser(object):
         return view_element.text  # stay as str structure! as character like '万' exist
 
     @staticmethod
-    def parse_comment_num(html):
-        num_element = html.find_element(By.CSS_SELECTOR, 'td:nth-child(2) > div')
+    def to_comment_num(num_str):
         try:
-            comment_num = int(num_element.text)  # be converted to int
+            comment_num = int(num_str)  # be converted to int
         except:
-            comment_num = int(float(num_element.text[:-1]) * 10000)  # 有时评论个数会过'万'
+            comment_num = int(float(num_str[:-1]) * 10000)  # 有时评论个数会过'万'
         return comment_num
 
+    def parse_comment_num(self, html):
+        num_element = html.find_element(By.CSS_SELECTOR, 'td:nth-child(2) > div')
+        return self.to_comment_num(num_element.text)
+
     @staticmethod
     def parse_post_url(html):
         url_element = html.find_element(By.CSS_SELECTOR, 'td:nth-child(3) > div > a')
         return url_element.get_attribute('href')
 
+    @staticmethod
+    def parse_post_id(post_url):
+        # 'http://guba.eastmoney.com/news,000002,1599326398.html' -> 1599326398, increases with the post time
+        match = re.search(r',(\d+)\.html', post_url)
+        return int(match.group(1)) if match else None
+
     @staticmethod
     def remove_char(date_str):
         # 使用正则表达式去掉所有汉字字符（处理日期中包含“修改”字符的情况）
         cleaned_str = re.sub(r'[^\d\s:-]', '', date_str)
         return cleaned_str.strip()
 
-    def get_post_year(self, html):
-        post_url = self.parse_post_url(html)
-        driver = webdriver.Chrome()
-
-        if 'guba.eastmoney.com' in post_url:  # 这是绝大部分的普通帖子
-            driver.get(post_url)
-            date_str = driver.find_element(By.CSS_SELECTOR, 'div.newsauthor > div.author-info.cl > div.time').text
-            self.year = int(self.remove_char(date_str)[:4])
-            driver.quit()
-        elif 'caifuhao.eastmoney.com' in post_url:  # 有些热榜帖子会占据第一位，对于这种情况要特殊处理
-            driver.get(post_url)
-            date_str = driver.find_element(By.CSS_SELECTOR, 'div.article.page-article > div.article-head > '
-                                                            'div.article-meta > span.txt').text
-            self.year = int(self.remove_char(date_str)[:4])
-            driver.quit()
-        else:
-            self.year = datetime.now().year
-
     @staticmethod
     def judge_post_date(html):  # eastmoney has several fucking inaccurate display dates
         try:
@@ -77,15 +109,11 @@ class PostParser(object):
             print('Fail to find the date of the post.', '\n', '{}'.format(e))
             return None, None
 
-        if self.judge_post_date(html):
-            if self.month < month == 12:
-                self.year -= 1
-            self.month = month
+        return self.infer_post_date(time_str, month, day, bool(self.judge_post_date(html)), self.parse_post_url(html))
 
-        if self.year is None:  # get the post year through exact post_url
-            self.get_post_year(html)
-
-        date = f'{self.year}-{month:02d}-{day:02d}'
+    def infer_post_date(self, time_str, month, day, accurate, post_url):
+        year = self.year_resolver.resolve(self.parse_post_id(post_url), post_url, month, day, accurate)
+        date = f'{year}-{month:02d}-{day:02d}'
         time = time_str.split(' ')[1]
         return date, time
 
@@ -95,7 +123,6 @@ class PostParser(object):
         return author_element.text
 
     def parse_post_info(self, html):
-        self.id += 1
         title = self.parse_post_title(html)
         view = self.parse_post_view(html)
         num = self.parse_comment_num(html)
@@ -103,7 +130,7 @@ class PostParser(object):
         date, time = self.parse_post_date(html)
         author = self.parse_post_author(html)
         post_info = {
-            '_id': self.id,
+            '_id': self.parse_post_id(url),  # the real guba id, so re-crawls and parallel crawls hit the same key
             'post_title': title,
             'post_view': view,
             'comment_num': num,
@@ -114,9 +141,66 @@ class PostParser(object):
         }
         return post_info
 
+    def parse_post_source(self, row, base_url):
+        # same fields as 'parse_post_info', but read from an lxml row of the page_source snapshot
+        url = urljoin(base_url, POST_SELECTORS['url'](row)[0].get('href'))
+        try:
+            time_str = first_text(POST_SELECTORS['date'], row)
+            month, day = map(int, time_str.split(' ')[0].split('-'))
+        except Exception as e:  # some post is different, just ignore it (very seldom)
+            print('Fail to find the date of the post.', '\n', '{}'.format(e))
+            date, time = None, None
+        else:
+            accurate = not POST_SELECTORS['judge'](row)  # '问董秘' posts display inaccurate dates
+            date, time = self.infer_post_date(time_str, month, day, accurate, url)
+        post_info = {
+            '_id': self.parse_post_id(url),
+            'post_title': first_text(POST_SELECTORS['title'], row),
+            'post_view': first_text(POST_SELECTORS['view'], row),
+            'comment_num': self.to_comment_num(first_text(POST_SELECTORS['comment_num'], row)),
+            'post_url': url,
+            'post_date': date,
+            'post_time': time,
+            'post_author': first_text(POST_SELECTORS['author'], row)
+        }
+        return post_info
+
+    @staticmethod
+    def parse_page_num(page_source):
+        return int(first_text(POST_SELECTORS['page_num'], lxml_html.fromstring(page_source)))
+
+    def parse_post_page(self, page_source, base_url, skip_first=False):
+        # parse every '.listitem' of one snapshot without any WebDriver round trip
+        rows = POST_SELECTORS['row'](lxml_html.fromstring(page_source))
+        if skip_first:
+            rows = rows[1:]
+        return [self.parse_post_source(row, base_url) for row in rows]
+
 
 class CommentParser(object):
 
+    @staticmethod
+    def comment_id(comment_info, occurrence: int = 0):
+        # replies have no id in the page, derive a stable one from the reply itself so re-crawls upsert in place
+        key = '|'.join(str(comment_info[field]) for field in
+                       ('comment_date', 'comment_time', 'sub_comment', 'comment_content'))
+        if occurrence:  # the n-th identical reply, see 'number_duplicates'
+            key += f'|{occurrence}'
+        return f"{comment_info['post_id']}_{hashlib.md5(key.encode('utf-8')).hexdigest()[:16]}"
+
+    @staticmethod
+    def number_duplicates(dic_list, counts: dict = None):
+        # identical short replies of the same minute (several '顶' in a row) would share one id and only the
+        # last would be kept, the later ones get their position among the identical replies into the id;
+        # 'counts' carries the positions over from the earlier pages of the same post
+        counts = {} if counts is None else counts
+        for comment_info in dic_list:
+            occurrence = counts.get(comment_info['_id'], 0)
+            counts[comment_info['_id']] = occurrence + 1
+            if occurrence:
+                comment_info['_id'] = CommentParser.comment_id(comment_info, occurrence)
+        return dic_list
+
     @staticmethod
     def judge_sub_comment(html):  # identify whether it has sub-comments
         sub = html.find_elements(By.CSS_SELECTOR, 'ul.replyListL2')  # must use '_elements' instead of '_element'
@@ -166,4 +250,59 @@ class CommentParser(object):
             'comment_time': time,
             'sub_comment': whether_subcomment,
         }
+        comment_info['_id'] = self.comment_id(comment_info)
         return comment_info
+
+    def parse_comment_source(self, row, post_id, sub_bool: bool = False):
+        # same fields as 'parse_comment_info', but read from an lxml node of the page_source snapshot
+        prefix = 'sub_' if sub_bool else ''
+        like = first_text(COMMENT_SELECTORS[prefix + 'like'], row)
+        date_str = first_text(COMMENT_SELECTORS[prefix + 'date'], row)
+        comment_info = {
+            'post_id': post_id,
+            'comment_content': first_text(COMMENT_SELECTORS[prefix + 'content'], row),
+            'comment_like': 0 if like == '点赞' else int(like),
+            'comment_date': date_str.split(' ')[0],
+            'comment_time': date_str.split(' ')[1][:5],
+            'sub_comment': int(sub_bool),
+        }
+        comment_info['_id'] = self.comment_id(comment_info)
+        return comment_info
+
+    def parse_comment_json(self, reply, post_id, sub_bool: bool = False):
+        # same fields as 'parse_comment_info', but read from one reply of the guba reply data endpoint
+        date_str = reply.get('reply_publish_time') or reply['reply_time']  # 'YYYY-MM-DD HH:MM:SS'
+        text = reply.get('reply_text') or ''
+        comment_info = {
+            'post_id': post_id,
+            # the text may carry emoji <img> and links, keep what the rendered page shows as text
+            'comment_content': node_text(lxml_html.fragment_fromstring(text, create_parent='span')) if text else '',
+            'comment_like': int(reply.get('reply_like_count') or 0),
+            'comment_date': date_str.split(' ')[0],
+            'comment_time': date_str.split(' ')[1][:5],
+            'sub_comment': int(sub_bool),
+        }
+        comment_info['_id'] = self.comment_id(comment_info)
+        return comment_info
+
+    def parse_reply_data(self, data, post_id, number: bool = True):
+        # one page of the reply endpoint, sub-replies follow their reply like in 'parse_comment_page';
+        # 'number=False' leaves the numbering of identical replies to the caller, across the pages of the post
+        if data.get('re') is None:  # {'rc': 0, 'me': '...'} when the request is refused
+            raise ValueError(f"回复接口返回错误 {data.get('me')}")
+        dic_list = []
+        for reply in data['re']:
+            dic_list.append(self.parse_comment_json(reply, post_id))
+            for sub_reply in reply.get('child_replys') or []:
+                dic_list.append(self.parse_comment_json(sub_reply, post_id, True))
+        return self.number_duplicates(dic_list) if number else dic_list
+
+    def parse_comment_page(self, page_source, post_id):
+        # parse every reply (and its sub-replies) of one snapshot without any WebDriver round trip
+        dic_list = []
+        for item in COMMENT_SELECTORS['row'](lxml_html.fromstring(page_source)):
+            dic_list.append(self.parse_comment_source(item, post_id))
+            if COMMENT_SELECTORS['sub_judge'](item):  # means it has sub-comments
+                for subitem in COMMENT_SELECTORS['sub_row'](item):
+                    dic_list.append(self.parse_comment_source(subitem, post_id, True))
+        return self.number_duplicates(dic_list)
@@ -8,17 +8,31 @@
 import asyncio
 import logging
 import json
+import os
 from datetime import datetime
 import re
 
+from rate_limiter import AdaptiveRateLimiter, expected_title
+from resource_blocker import ResourceBlocker
+from readiness import ReadinessWaiter
+
 class PlaywrightEastMoneyCrawler:
     """使用原生Playwright的东方财富爬虫"""
     
-    def __init__(self, stock_code="002001", stock_name="新和成"):
+    def __init__(self, stock_code="002001", stock_name="新和成", block_resources=True, ready_timeout=10):
         self.stock_code = stock_code
         self.stock_name = stock_name
         self.base_url = f"https://guba.eastmoney.com/list,{stock_code}.html"
         
+        # 按域名自适应调整请求速率，代替固定的重试等待
+        self.limiter = AdaptiveRateLimiter()
+        
+        # 屏蔽图片、字体、样式表和广告统计脚本，解析只需要文本
+        self.blocker = ResourceBlocker() if block_resources else None
+        
+        # 等待解析所需的元素出现，代替固定的 sleep
+        self.readiness = ReadinessWaiter(timeout=ready_timeout)
+        
         # 设置日志
         logging.basicConfig(
             level=logging.INFO,
@@ -64,6 +78,9 @@ class PlaywrightEastMoneyCrawler:
             self.page.set_default_timeout(60000)
             self.page.set_default_navigation_timeout(60000)
             
+            if self.blocker is not None:
+                await self.blocker.attach(self.page)
+            
             self.logger.info("✅ Playwright浏览器初始化成功")
             return True
             
@@ -75,24 +92,25 @@ class PlaywrightEastMoneyCrawler:
         """安全的页面导航"""
         for attempt in range(max_retries):
             try:
-                self.logger.info(f"尝试访问页面 (第{attempt+1}次): {url}")
+                # 限流信号之后的重试会自动等待更久
+                await self.limiter.wait_async(url)
+                self.logger.info(f"尝试访问页面 (第{attempt+1}次): {url}，当前速率 {self.limiter.rate(url):.2f} 页/秒")
                 
                 await self.page.goto(url, wait_until='domcontentloaded', timeout=45000)
-                await asyncio.sleep(3)
                 
                 # 检查页面是否正确加载
                 title = await self.page.title()
-                if title and ("东方财富" in title or "股吧" in title):
+                if expected_title(title):
                     self.logger.info(f"✅ 页面加载成功: {title}")
                     return True
                 else:
                     self.logger.warning(f"页面标题异常: {title}")
+                    self.limiter.throttled(url, 'title')
                     
             except Exception as e:
                 self.logger.warning(f"第{attempt+1}次访问失败: {e}")
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(5)
-                else:
+                self.limiter.throttled(url, 'timeout' if 'Timeout' in type(e).__name__ else 'error')
+                if attempt == max_retries - 1:
                     self.logger.error("所有访问尝试都失败了")
                     return False
         
@@ -107,9 +125,6 @@ class PlaywrightEastMoneyCrawler:
             if not await self.safe_goto(self.base_url):
                 return 0
             
-            # 等待页面完全加载
-            await asyncio.sleep(5)
-            
             # 尝试多种选择器来找到帖子列表
             selectors = [
                 'tr.listitem',
@@ -119,6 +134,9 @@ class PlaywrightEastMoneyCrawler:
                 'tbody tr'
             ]
             
+            # 等待帖子列表出现，超过上限时按原逻辑继续（正则兜底）
+            await self.readiness.wait_page(self.page, selectors, 'post_list')
+            
             post_elements = []
             for selector in selectors:
                 try:
@@ -131,6 +149,15 @@ class PlaywrightEastMoneyCrawler:
                     self.logger.debug(f"选择器 '{selector}' 失败: {e}")
                     continue
             
+            if self.blocker is not None:
+                self.blocker.log_page(self.page, self.base_url)
+            
+            # 没有 .listitem 的列表页通常意味着被限制访问
+            if post_elements:
+                self.limiter.success(self.base_url)
+            else:
+                self.limiter.throttled(self.base_url, 'empty')
+            
             if not post_elements:
                 self.logger.warning("未找到帖子元素，尝试获取页面内容进行分析")
                 
@@ -217,8 +244,14 @@ class PlaywrightEastMoneyCrawler:
             self.logger.error(f"爬取帖子失败: {e}")
             return 0
     
-    async def save_data(self):
-        """保存数据到JSON文件"""
+    async def save_data(self, format='json', parquet_root='parquet'):
+        """
+        保存数据
+        :param format: 'json' 每次运行写一对 JSON 文件; 'parquet' 追加到按股票代码和日期分区的 Parquet 数据集
+        :param parquet_root: Parquet 数据集的根目录
+        """
+        if format == 'parquet':
+            return self.save_parquet(parquet_root)
         try:
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             
@@ -242,6 +275,25 @@ class PlaywrightEastMoneyCrawler:
             self.logger.error(f"保存数据失败: {e}")
             return None, None
     
+    def save_parquet(self, root):
+        """追加写入 Parquet（需要 pyarrow）"""
+        try:
+            from exporter import ParquetExporter
+            
+            exporter = ParquetExporter(root)
+            posts_count = exporter.write('posts', self.posts_data, self.stock_code)
+            comments_count = exporter.write('comments', self.comments_data, self.stock_code)
+            
+            self.logger.info(f"✅ 数据已追加到 Parquet 数据集 {root}:")
+            self.logger.info(f"   帖子数据: {posts_count} 条")
+            self.logger.info(f"   评论数据: {comments_count} 条")
+            
+            return os.path.join(root, 'posts'), os.path.join(root, 'comments')
+            
+        except Exception as e:
+            self.logger.error(f"保存数据失败: {e}")
+            return None, None
+    
     async def run(self):
         """运行爬虫"""
         try:
@@ -264,6 +316,11 @@ class PlaywrightEastMoneyCrawler:
                 self.logger.info("=== 爬取完成 ===")
                 self.logger.info(f"总帖子数: {len(self.posts_data)}")
                 self.logger.info(f"总评论数: {len(self.comments_data)}")
+                for line in self.readiness.describe():
+                    self.logger.info(line)
+                if self.blocker is not None:
+                    self.logger.info(f"共屏蔽 {self.blocker.total['requests']} 个请求，"
+                                     f"约节省 {self.blocker.total['bytes'] / 1024 / 1024:.1f} MB")
                 
                 return True
             else:
@@ -0,0 +1,100 @@
+from urllib.parse import urlparse
+import asyncio
+import random
+import threading
+import time
+
+from metrics import METRICS
+
+
+# every guba / eastmoney page has one of these in its title, a verification or error page does not
+EXPECTED_TITLES = ('东方财富', '股吧')
+
+
+def expected_title(title):
+    return bool(title) and any(word in title for word in EXPECTED_TITLES)
+
+
+class HostState(object):
+
+    def __init__(self, rate: float):
+        self.rate = rate  # requests per second
+        self.next_time = 0.0  # the earliest moment of the next request
+        self.requests = 0
+        self.throttles = {}  # reason -> count
+
+
+class AdaptiveRateLimiter(object):
+    # AIMD pacing per host: the rate climbs a little after every healthy response and is cut
+    # sharply on throttling signals (empty list pages, timeouts, unexpected titles)
+
+    def __init__(self, initial_rate: float = 4.0, min_rate: float = 0.2, max_rate: float = 20.0,
+                 increase: float = 0.5, decrease: float = 0.5, cooldown: float = 2.0, jitter: float = 0.2):
+        """
+        :param initial_rate/min_rate/max_rate: 每个域名每秒的请求数
+        :param increase: 每次正常响应后增加的速率（加性增加）
+        :param decrease: 出现限流信号时速率乘以的系数（乘性减少）
+        :param cooldown: 出现限流信号后暂停该域名的秒数
+        :param jitter: 请求间隔的随机浮动比例，避免固定节奏
+        """
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.jitter = jitter
+        self.hosts = {}  # netloc -> HostState
+        self.lock = threading.Lock()  # shared by crawler threads; the event loop only holds it briefly
+
+    def host(self, url):
+        netloc = urlparse(url).netloc
+        state = self.hosts.get(netloc)
+        if state is None:
+            state = self.hosts[netloc] = HostState(self.initial_rate)
+        return state
+
+    def reserve(self, url):
+        # book the next slot of the host, returns how long the caller has to wait for it
+        with self.lock:
+            state = self.host(url)
+            now = time.monotonic()
+            slot = max(now, state.next_time)
+            state.next_time = slot + random.uniform(1 - self.jitter, 1 + self.jitter) / state.rate
+            state.requests += 1
+            return slot - now
+
+    def wait(self, url):
+        time.sleep(self.reserve(url))
+
+    async def wait_async(self, url):
+        await asyncio.sleep(self.reserve(url))
+
+    def success(self, url):
+        with self.lock:
+            state = self.host(url)
+            state.rate = min(self.max_rate, state.rate + self.increase)
+
+    def throttled(self, url, reason: str):
+        """
+        :param reason: 'empty' 页面没有帖子, 'timeout' 超时, 'title' 页面标题异常, 'error' 其他请求错误
+        """
+        with self.lock:
+            state = self.host(url)
+            state.rate = max(self.min_rate, state.rate * self.decrease)
+            state.next_time = max(state.next_time, time.monotonic() + self.cooldown)
+            state.throttles[reason] = state.throttles.get(reason, 0) + 1
+        METRICS.inc('guba_throttled_total', host=urlparse(url).netloc, reason=reason)
+
+    def rate(self, url):
+        with self.lock:
+            return self.host(url).rate
+
+    def stats(self):
+        with self.lock:
+            return {netloc: {'rate': state.rate, 'requests': state.requests, 'throttles': dict(state.throttles)}
+                    for netloc, state in self.hosts.items()}
+
+
+# one limiter per process, so post and comment crawlers share the budget of a host
+LIMITER = AdaptiveRateLimiter()
@@ -0,0 +1,78 @@
+import threading
+import time
+
+from metrics import METRICS
+
+
+class ReadinessWaiter(object):
+    # waits until the elements the parsers read are on the page, instead of sleeping a fixed time,
+    # and keeps timing stats of how long pages really took to get ready
+
+    def __init__(self, timeout: float = 10.0, poll: float = 0.05, labels: dict = None):
+        """
+        :param timeout: 等待元素出现的上限（秒），超时后按原来的逻辑继续（解析、刷新或重试）
+        :param poll: selenium 检查元素的间隔（秒）
+        :param labels: 指标标签，例如 {'symbol': '000002', 'backend': 'browser'}
+        """
+        self.timeout = timeout
+        self.poll = poll
+        self.labels = labels or {}
+        self.stats = {}  # label -> {'waits', 'timeouts', 'total_seconds', 'max_seconds'}
+        self.lock = threading.Lock()
+
+    def record(self, label: str, seconds: float, ready: bool):
+        with self.lock:
+            stats = self.stats.setdefault(label, {'waits': 0, 'timeouts': 0, 'total_seconds': 0.0,
+                                                  'max_seconds': 0.0})
+            stats['waits'] += 1
+            stats['timeouts'] += not ready
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        METRICS.observe('guba_stage_seconds', seconds, stage='readiness', page=label, **self.labels)
+        if not ready:
+            METRICS.inc('guba_readiness_timeouts_total', page=label, **self.labels)
+
+    async def wait_page(self, page, selectors, label: str, timeout: float = None):
+        """
+        playwright 页面，任意一个选择器匹配到元素即视为就绪
+        :param selectors: 解析时使用的 CSS 选择器列表
+        :param label: 统计用的名称，例如 'post_list'、'comment'
+        :return: 是否在上限内就绪
+        """
+        from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+        start = time.perf_counter()
+        try:
+            await page.wait_for_selector(', '.join(selectors), state='attached',
+                                         timeout=(timeout or self.timeout) * 1000)
+            ready = True
+        except PlaywrightTimeoutError:
+            ready = False
+        self.record(label, time.perf_counter() - start, ready)
+        return ready
+
+    def wait_browser(self, browser, selectors, label: str, timeout: float = None):
+        """selenium webdriver，参数同 wait_page"""
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException
+        start = time.perf_counter()
+        try:
+            WebDriverWait(browser, timeout or self.timeout, poll_frequency=self.poll).until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, ', '.join(selectors))))
+            ready = True
+        except TimeoutException:
+            ready = False
+        self.record(label, time.perf_counter() - start, ready)
+        return ready
+
+    def summary(self):
+        with self.lock:
+            return {label: dict(stats, avg_seconds=stats['total_seconds'] / stats['waits'])
+                    for label, stats in self.stats.items()}
+
+    def describe(self):
+        # one line per label for the progress output
+        return [f"{label}: 等待 {stats['waits']} 次，平均 {stats['avg_seconds']:.3f} 秒，"
+                f"最长 {stats['max_seconds']:.3f} 秒，超时 {stats['timeouts']} 次"
+                for label, stats in self.summary().items()]
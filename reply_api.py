@@ -0,0 +1,47 @@
+from urllib.parse import urlencode
+import math
+
+from fetcher import HttpFetcher
+
+
+# the endpoint a guba post page calls for its replies (see the XHR list of the browser)
+REPLY_API_URL = 'https://guba.eastmoney.com/api/getData'
+REPLY_API_PATH = 'reply/api/Reply/ArticleNewReplyList'
+REPLY_PAGE_SIZE = 30
+
+
+class ReplyApiClient(object):
+    # structured replies of a post over plain HTTP, no browser rendering involved
+
+    def __init__(self, fetcher: HttpFetcher = None, api_url: str = REPLY_API_URL, page_size: int = REPLY_PAGE_SIZE):
+        """
+        :param fetcher: 复用的 HttpFetcher（和浏览器共享 cookie 时传入）
+        :param api_url: 回复接口地址，可以指向本地提供录制 JSON 的服务器
+        :param page_size: 每页回复数
+        """
+        self.fetcher = fetcher or HttpFetcher()
+        self.api_url = api_url
+        self.page_size = page_size
+
+    def form(self, post_id, page: int):
+        return {
+            'param': urlencode({'postid': post_id, 'sort': 1, 'sorttype': 1, 'p': page, 'ps': self.page_size}),
+            'path': REPLY_API_PATH,
+            'plat': 'Web',
+            'env': 2,
+            'origin': '',
+            'version': 2022,
+            'product': 'Guba',
+        }
+
+    def fetch_page(self, post_id, page: int = 1, referer: str = None):
+        """
+        :param referer: 帖子链接，接口会校验来源页面
+        :return: 接口返回的 JSON，回复在 're' 中
+        """
+        headers = {'Referer': referer} if referer else None
+        return self.fetcher.post_json(f'{self.api_url}?path={REPLY_API_PATH}', self.form(post_id, page), headers)
+
+    def page_count(self, data):
+        # 'count' is the number of top-level replies of the post, their sub-replies come along with them
+        return max(1, math.ceil((data.get('count') or 0) / self.page_size))
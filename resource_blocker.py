@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Playwright 网络请求拦截
+解析器只读取文本，图片、字体、样式表和广告统计脚本在 page.route 中直接中止
+"""
+
+import logging
+from urllib.parse import urlparse
+
+
+# 按资源类型屏蔽
+BLOCKED_RESOURCE_TYPES = ('image', 'media', 'font', 'stylesheet')
+
+# 按域名屏蔽（广告和统计），子域名同样生效
+BLOCKED_DOMAINS = (
+    'hm.baidu.com',
+    'cnzz.com',
+    'google-analytics.com',
+    'googletagmanager.com',
+    'googlesyndication.com',
+    'doubleclick.net',
+)
+
+# 解析器依赖的请求，包含这些片段的 URL 永远放行
+ALLOWED_URL_PARTS = (
+    'guba.eastmoney.com/list',
+    'guba.eastmoney.com/news',
+    'gbapi.eastmoney.com',
+    'guba.eastmoney.com/api',
+)
+
+# 被屏蔽请求无法得知真实大小，按资源类型估算（字节）
+ESTIMATED_BYTES = {
+    'image': 30 * 1024,
+    'media': 200 * 1024,
+    'font': 60 * 1024,
+    'stylesheet': 20 * 1024,
+    'script': 40 * 1024,
+}
+DEFAULT_ESTIMATED_BYTES = 5 * 1024
+
+
+class ResourceBlocker:
+    """可配置的资源屏蔽器，按页面统计节省的请求数和估算字节数"""
+
+    def __init__(self, resource_types=BLOCKED_RESOURCE_TYPES, domains=BLOCKED_DOMAINS,
+                 allowed=ALLOWED_URL_PARTS):
+        self.resource_types = set(resource_types)
+        self.domains = tuple(domains)
+        self.allowed = tuple(allowed)
+        self.logger = logging.getLogger(__name__)
+
+        self.page_stats = {}  # page -> 自上次 take() 以来屏蔽的 {'requests', 'bytes'}
+        self.total = {'requests': 0, 'bytes': 0}
+
+    def should_block(self, url, resource_type):
+        """白名单优先，其次按资源类型和域名判断"""
+        if any(part in url for part in self.allowed):
+            return False
+        if resource_type in self.resource_types:
+            return True
+        host = urlparse(url).hostname or ''
+        return any(host == domain or host.endswith('.' + domain) for domain in self.domains)
+
+    async def attach(self, page):
+        """为页面注册拦截规则"""
+        stats = self.page_stats.setdefault(page, {'requests': 0, 'bytes': 0})
+
+        async def handle(route):
+            request = route.request
+            if self.should_block(request.url, request.resource_type):
+                size = ESTIMATED_BYTES.get(request.resource_type, DEFAULT_ESTIMATED_BYTES)
+                stats['requests'] += 1
+                stats['bytes'] += size
+                self.total['requests'] += 1
+                self.total['bytes'] += size
+                await route.abort()
+            else:
+                await route.continue_()
+
+        await page.route('**/*', handle)
+
+    def take(self, page):
+        """取出页面自上次调用以来的屏蔽统计并清零，通常每次导航后调用一次"""
+        stats = self.page_stats.get(page, {'requests': 0, 'bytes': 0})
+        taken = dict(stats)
+        stats['requests'] = stats['bytes'] = 0
+        return taken
+
+    def log_page(self, page, url):
+        """记录一个页面节省的请求"""
+        stats = self.take(page)
+        self.logger.info(f"已屏蔽 {stats['requests']} 个请求，约节省 {stats['bytes'] / 1024:.0f} KB: {url}")
+
+    def detach(self, page):
+        """页面关闭后丢弃它的统计"""
+        self.page_stats.pop(page, None)
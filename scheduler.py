@@ -0,0 +1,158 @@
+from multiprocessing import Pool
+from itertools import zip_longest
+import argparse
+import glob
+import os
+import time
+
+from crawler import PostCrawler, CommentCrawler
+from metrics import METRICS, SnapshotWriter, snapshot_path
+
+
+def split_pages(page1: int, page2: int, chunk_pages: int = None):
+    # [(1, 50), (51, 100), ...] so one big symbol can not occupy a worker for the whole run
+    if chunk_pages is None:
+        return [(page1, page2)]
+    return [(start, min(start + chunk_pages - 1, page2)) for start in range(page1, page2 + 1, chunk_pages)]
+
+
+def round_robin(task_lists):
+    # take one task of every symbol in turn: a, b, c, a, b, c, ...
+    return [task for group in zip_longest(*task_lists) for task in group if task is not None]
+
+
+def start_worker_metrics(metrics_dir, interval):
+    # every worker process writes its own snapshot, the scheduler endpoint adds them up
+    if metrics_dir is not None:
+        SnapshotWriter(METRICS, snapshot_path(metrics_dir), interval).start()
+
+
+def run_task(task):
+    # executed inside a worker process, every task starts (and quits) its own browser
+    kind, symbol = task['kind'], task['symbol']
+    start = time.time()
+    result = {'kind': kind, 'symbol': symbol, 'pages': 0, 'rows': 0, 'error': None}
+    try:
+        if kind == 'post':
+            crawler = PostCrawler(symbol, backend=task['backend'], seen_dir=task['seen_dir'])
+            crawler.crawl_post_info(task['page1'], task['page2'], concurrency=task['concurrency'])
+            result['pages'] = task['page2'] - task['page1'] + 1
+        else:
+            crawler = CommentCrawler(symbol, backend=task['backend'], seen_dir=task['seen_dir'])
+            if task['delta']:  # only the posts whose comment_num grew since their comments were stored
+                crawler.find_changed(task['start_date'], task['end_date'])
+            else:
+                crawler.find_by_date(task['start_date'], task['end_date'])
+            crawler.crawl_comment_info()
+            result['pages'] = crawler.current_num
+        result['rows'] = crawler.row_count
+    except Exception as e:  # one broken symbol must not stop the others
+        print(f'{symbol}: 任务 {task} 失败 {e}')
+        result['error'] = str(e)
+    result['seconds'] = time.time() - start
+    if task['metrics_dir'] is not None:  # the task is in the snapshot even if the pool ends before the next tick
+        METRICS.write_snapshot(snapshot_path(task['metrics_dir']))
+    return result
+
+
+class CrawlScheduler(object):
+
+    def __init__(self, symbols, workers: int = None, chunk_pages: int = 50, backend: str = 'browser',
+                 concurrency: int = 1, comment_backend: str = 'browser', seen_dir: str = None,
+                 comment_delta: bool = False, metrics_dir: str = None, metrics_interval: float = 30.0):
+        """
+        :param symbols: ['000002', '600438', ...] 股票代码列表
+        :param workers: 工作进程数，默认等于 CPU 核数
+        :param chunk_pages: 每个帖子任务包含的页数，越小各股票之间越公平；None 表示每只股票一个任务
+        :param backend/concurrency: 传给 PostCrawler 的抓取方式和并发页数
+        :param comment_backend: 传给 CommentCrawler 的抓取方式，'browser' 或 'api'
+        :param seen_dir: 已爬帖子 filter 文件的目录，所有工作进程共用（合并写入）；None 表示不使用
+        :param comment_delta: 评论只补爬评论数增加了的帖子（CommentCrawler.find_changed），不给日期时比较全部帖子
+        :param metrics_dir: 工作进程的指标快照目录（每个进程一个 metrics_{pid}.json）；None 表示不写入
+        :param metrics_interval: 写入快照的间隔（秒）
+        """
+        self.symbols = list(symbols)
+        self.workers = workers or os.cpu_count()
+        self.chunk_pages = chunk_pages
+        self.backend = backend
+        self.concurrency = concurrency
+        self.comment_backend = comment_backend
+        self.seen_dir = seen_dir
+        self.comment_delta = comment_delta
+        self.metrics_dir = metrics_dir
+        self.metrics_interval = metrics_interval
+        self.summary = {symbol: {'post_pages': 0, 'post_rows': 0, 'comment_pages': 0, 'comment_rows': 0,
+                                 'seconds': 0.0, 'errors': 0} for symbol in self.symbols}
+
+    def post_tasks(self, page1: int, page2: int):
+        return round_robin([[{'kind': 'post', 'symbol': symbol, 'page1': start, 'page2': stop,
+                              'backend': self.backend, 'concurrency': self.concurrency, 'seen_dir': self.seen_dir,
+                              'metrics_dir': self.metrics_dir}
+                             for start, stop in split_pages(page1, page2, self.chunk_pages)]
+                            for symbol in self.symbols])
+
+    def comment_tasks(self, start_date: str, end_date: str):
+        return [{'kind': 'comment', 'symbol': symbol, 'start_date': start_date, 'end_date': end_date,
+                 'backend': self.comment_backend, 'seen_dir': self.seen_dir, 'delta': self.comment_delta,
+                 'metrics_dir': self.metrics_dir}
+                for symbol in self.symbols]
+
+    def run_tasks(self, tasks):
+        with Pool(processes=self.workers, initializer=start_worker_metrics,
+                  initargs=(self.metrics_dir, self.metrics_interval)) as pool:
+            # chunksize=1: idle workers pull the next task in round-robin order
+            for result in pool.imap_unordered(run_task, tasks, chunksize=1):
+                stats = self.summary[result['symbol']]
+                stats[f"{result['kind']}_pages"] += result['pages']
+                stats[f"{result['kind']}_rows"] += result['rows']
+                stats['seconds'] += result['seconds']
+                stats['errors'] += result['error'] is not None
+
+    def clear_metrics(self):
+        # snapshots of the workers of an earlier run would be added to this one
+        if self.metrics_dir is not None:
+            for path in glob.glob(os.path.join(self.metrics_dir, 'metrics_*.json')):
+                os.remove(path)
+
+    def run(self, page1: int = None, page2: int = None, start_date: str = None, end_date: str = None):
+        # posts first, as comments are selected from the crawled posts
+        self.clear_metrics()
+        if page1 is not None and page2 is not None:
+            self.run_tasks(self.post_tasks(page1, page2))
+        if (start_date is not None and end_date is not None) or self.comment_delta:
+            self.run_tasks(self.comment_tasks(start_date, end_date))
+        self.print_summary()
+        return self.summary
+
+    def print_summary(self):
+        print(f'共 {len(self.symbols)} 只股票，{self.workers} 个工作进程')
+        for symbol, stats in self.summary.items():
+            print(f"{symbol}: 帖子 {stats['post_pages']} 页 {stats['post_rows']} 条，"
+                  f"评论 {stats['comment_pages']} 页 {stats['comment_rows']} 条，"
+                  f"耗时 {stats['seconds']/60:.2f} 分钟，失败任务 {stats['errors']} 个")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='多股票多进程爬取')
+    arg_parser.add_argument('symbols', nargs='+', help='股票代码，例如 000002 600438')
+    arg_parser.add_argument('--pages', nargs=2, type=int, metavar=('PAGE1', 'PAGE2'), help='帖子页码范围')
+    arg_parser.add_argument('--dates', nargs=2, metavar=('START', 'END'), help='评论对应的发帖日期范围')
+    arg_parser.add_argument('--workers', type=int, default=None)
+    arg_parser.add_argument('--chunk-pages', type=int, default=50)
+    arg_parser.add_argument('--backend', choices=['browser', 'http'], default='browser')
+    arg_parser.add_argument('--concurrency', type=int, default=1)
+    arg_parser.add_argument('--comment-backend', choices=['browser', 'api'], default='browser',
+                            help="'browser' 只读到帖子第一屏的回复，'api' 抓取全部回复页")
+    arg_parser.add_argument('--seen-dir', default=None, help='已爬帖子 filter 文件目录，例如 seen')
+    arg_parser.add_argument('--comment-delta', action='store_true', help='只补爬评论数增加了的帖子')
+    arg_parser.add_argument('--metrics-dir', default=None, help='指标快照目录，例如 metrics')
+    arg_parser.add_argument('--metrics-port', type=int, default=None, help='prometheus 指标端口，需要 --metrics-dir')
+    args = arg_parser.parse_args()
+    if args.metrics_port is not None and args.metrics_dir is None:  # the crawls run in the workers, not here
+        arg_parser.error('--metrics-port 需要同时指定 --metrics-dir，否则只能看到主进程的空指标')
+
+    scheduler = CrawlScheduler(args.symbols, args.workers, args.chunk_pages, args.backend, args.concurrency,
+                               args.comment_backend, args.seen_dir, args.comment_delta, args.metrics_dir)
+    if args.metrics_port is not None:
+        METRICS.serve(args.metrics_port, snapshot_dir=args.metrics_dir)
+    scheduler.run(*(args.pages or (None, None)), *(args.dates or (None, None)))
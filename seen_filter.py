@@ -0,0 +1,129 @@
+from contextlib import contextmanager
+import hashlib
+import math
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
+
+
+HEADER = struct.Struct('>4sQI')  # magic, number of bits, number of hashes
+MAGIC = b'BLM1'
+
+
+@contextmanager
+def file_lock(path):
+    # one writer at a time across threads, processes and scheduler workers
+    with open(path + '.lock', 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class BloomFilter(object):
+    # a fixed-size bit array: no false negatives, about 'error_rate' false positives at 'capacity' keys
+
+    def __init__(self, capacity: int = 1000000, error_rate: float = 0.001, bit_count: int = None,
+                 hash_count: int = None):
+        self.bit_count = bit_count or int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = hash_count or max(1, round(self.bit_count / capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.bit_count for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def merge(self, other):
+        # OR of two filters of the same size, e.g. what another worker saved in the meantime
+        if (other.bit_count, other.hash_count) != (self.bit_count, self.hash_count):
+            raise ValueError('只能合并大小相同的 Bloom filter')
+        merged = int.from_bytes(self.bits, 'big') | int.from_bytes(other.bits, 'big')
+        self.bits = bytearray(merged.to_bytes(len(self.bits), 'big'))
+
+    def to_bytes(self):
+        return HEADER.pack(MAGIC, self.bit_count, self.hash_count) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, bit_count, hash_count = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('不是 Bloom filter 文件')
+        bloom = cls(bit_count=bit_count, hash_count=hash_count)
+        bloom.bits = bytearray(data[HEADER.size:])
+        return bloom
+
+
+class SeenPosts(object):
+    # post ids crawled before, kept in a bloom filter file shared by runs and workers;
+    # a hit is confirmed by an exact check (mongo), so a false positive never skips a new post
+
+    def __init__(self, path: str, exact_check=None, capacity: int = 1000000, error_rate: float = 0.001):
+        """
+        :param path: filter 文件路径，不存在时新建
+        :param exact_check: 函数 post_id -> 记录或 None，确认命中的帖子确实处理过；None 表示只信任 filter
+        :param capacity/error_rate: 新建 filter 时的容量和误判率（已有文件沿用文件中的大小）
+        """
+        self.path = path
+        self.exact_check = exact_check
+        self.lock = threading.Lock()
+        self.bloom = self.load() or BloomFilter(capacity, error_rate)
+        self.hits = 0  # confirmed, the navigation was skipped
+        self.false_positives = 0
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            return BloomFilter.from_bytes(f.read())
+
+    def seen(self, post_id):
+        # None for a new post, else what the exact check found (True without an exact check)
+        if post_id is None or post_id not in self.bloom:
+            return None
+        found = self.exact_check(post_id) if self.exact_check is not None else True
+        if not found:
+            self.false_positives += 1
+            return None
+        self.hits += 1
+        return found
+
+    def add(self, post_id):
+        if post_id is not None:
+            with self.lock:
+                self.bloom.add(post_id)
+
+    def save(self):
+        # merge with what other runs saved since we loaded, then replace the file atomically
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with file_lock(self.path), self.lock:
+            saved = self.load()
+            if saved is not None:
+                self.bloom.merge(saved)
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.bloom.to_bytes())
+            os.replace(tmp_path, self.path)
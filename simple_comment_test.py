@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from crawler import CommentCrawler
+from mongodb import MongoAPI
 
 def test_simple():
     print("开始测试评论爬虫...")
@@ -11,17 +12,20 @@ def test_simple():
     
     # 测试按ID范围查找（这样可以避免日期字段的问题）
     print("测试按ID范围查找帖子...")
-    comment_crawler.find_by_id(1, 100)  # 查找前100条帖子
+    postdb = MongoAPI('post_info', 'post_600438')
+    ids = [doc['_id'] for doc in postdb.find({}, {'_id': 1}).sort('_id', 1).limit(100)]  # 帖子链接中的 id，约 1.5e9
+    if ids:
+        comment_crawler.find_by_id(ids[0], ids[-1])  # 查找最早的100条帖子
     
     # 如果找到了帖子，尝试爬取评论
-    if not comment_crawler.post_df.empty:
+    if ids and comment_crawler.post_total:
         print("找到帖子，开始爬取评论...")
         comment_crawler.crawl_comment_info()
     else:
         print("没有找到帖子，尝试按日期查找...")
         comment_crawler.find_by_date('2025-08-01', '2025-12-31')
         
-        if not comment_crawler.post_df.empty:
+        if comment_crawler.post_total:
             print("按日期找到帖子，开始爬取评论...")
             comment_crawler.crawl_comment_info()
         else:
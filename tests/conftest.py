@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    # every MongoAPI in the test talks to one in-memory mongomock client instead of mongod
+    mongomock = pytest.importorskip('mongomock')
+    from mongomock.collection import BulkOperationBuilder
+    import mongodb
+
+    add_update = BulkOperationBuilder.add_update
+
+    def add_update_without_sort(self, *args, **kwargs):  # pymongo passes 'sort', mongomock does not know it
+        kwargs.pop('sort', None)
+        return add_update(self, *args, **kwargs)
+
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(BulkOperationBuilder, 'add_update', add_update_without_sort)
+    monkeypatch.setattr(mongodb, 'MongoClient', lambda host=None, port=None: client)
+    monkeypatch.setattr(mongodb.MongoAPI, 'ensured', set())
+    monkeypatch.setattr(mongodb.MongoAPI, 'clients', {})
+    return client
+
+
+@pytest.fixture
+def fixtures():
+    # 30 posts, two reply pages each
+    from benchmark import GubaFixtures
+    return GubaFixtures(pages=3, posts_per_page=10, replies=35, sub_replies=2)
+
+
+@pytest.fixture
+def server(fixtures):
+    # the fixtures served like guba on 127.0.0.1
+    from benchmark import FixtureServer
+    server = FixtureServer(fixtures).start()
+    yield server
+    server.stop()
@@ -0,0 +1,83 @@
+import threading
+import time
+
+import pytest
+
+from mongodb import BufferedMongoSink, SinkError
+
+
+class FakeMongo(object):
+    # records the batches, a write can be held back ('gate') or made to fail ('fail_on')
+
+    def __init__(self, fail_on: int = None):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.fail_on = fail_on
+
+    def bulk_upsert(self, batch):
+        self.gate.wait()
+        if not batch:  # like MongoAPI.bulk_upsert, a batch of only callbacks writes nothing
+            return
+        if self.fail_on is not None and len(self.batches) == self.fail_on:
+            self.fail_on = None
+            raise RuntimeError('mongo blip')
+        self.batches.append([doc['_id'] for doc in batch])
+
+
+def docs(*ids):
+    return [{'_id': i} for i in ids]
+
+
+def test_callbacks_run_after_their_batch_is_written():
+    mongo = FakeMongo()
+    mongo.gate.clear()
+    done = []
+    sink = BufferedMongoSink(mongo, batch_size=2, max_age=60)
+    sink.put_many(docs(1, 2), on_flushed=lambda: done.append(('page', list(mongo.batches))))
+    sink.put_many([], on_flushed=lambda: done.append(('marker', list(mongo.batches))))
+    assert done == []  # the first batch is still being written
+    mongo.gate.set()
+    sink.close()
+    assert mongo.batches == [[1, 2]]
+    assert done == [('page', [[1, 2]]), ('marker', [[1, 2]])]
+
+
+def test_close_flushes_a_partly_filled_buffer():
+    mongo = FakeMongo()
+    done = []
+    sink = BufferedMongoSink(mongo, batch_size=100, max_age=60)
+    sink.put_many(docs(1, 2, 3), on_flushed=lambda: done.append(3))
+    assert mongo.batches == []
+    sink.close()
+    assert mongo.batches == [[1, 2, 3]]
+    assert done == [3]
+    assert sink.stats()['documents'] == 3
+
+
+def test_failed_write_stops_the_later_batches():
+    mongo = FakeMongo(fail_on=1)
+    mongo.gate.clear()  # all three are queued before the writer gets to the second
+    done = []
+    sink = BufferedMongoSink(mongo, batch_size=1, max_age=60)
+    sink.put_many(docs(1), on_flushed=lambda: done.append(1))
+    sink.put_many(docs(2), on_flushed=lambda: done.append(2))  # fails
+    sink.put_many(docs(3), on_flushed=lambda: done.append(3))
+    mongo.gate.set()
+    while sink.error is None:  # the writer reaches the failed batch
+        time.sleep(0.01)
+    with pytest.raises(SinkError):
+        sink.put_many(docs(4), on_flushed=lambda: done.append(4))
+    with pytest.raises(SinkError):
+        sink.close()
+    assert mongo.batches == [[1]]  # only the second write fails, 3 is skipped by the sink itself
+    assert done == [1]
+
+
+def test_close_raises_a_failed_final_write():
+    sink = BufferedMongoSink(FakeMongo(fail_on=0), batch_size=100, max_age=60)
+    sink.put_many(docs(1))
+    with pytest.raises(SinkError):
+        sink.close()
+    with pytest.raises(SinkError):  # every later call reports it too
+        sink.close()
@@ -0,0 +1,72 @@
+import functools
+
+import pytest
+
+import crawler as crawler_module
+import mongodb
+from benchmark import BENCH_SYMBOL, Benchmark, unthrottled_limiter
+from checkpoint import CrawlCheckpoint
+from crawler import PostCrawler, CommentCrawler
+from mongodb import BufferedMongoSink, SinkError
+
+
+def post_crawler(server):
+    return PostCrawler(BENCH_SYMBOL, backend='http', base_url=server.url, limiter=unthrottled_limiter())
+
+
+def listed(fixtures, *pages):
+    return sorted(post_id for page in pages for post_id in fixtures.post_ids(page))
+
+
+def test_post_crawl_resumes_after_the_saved_page(mongo, fixtures, server):
+    CrawlCheckpoint(f'post_{BENCH_SYMBOL}_1_3').save(page=1)
+    post_crawler(server).crawl_post_info(1, 3)
+    stored = mongo.post_info[f'post_{BENCH_SYMBOL}']
+    assert sorted(post['_id'] for post in stored.find()) == listed(fixtures, 2, 3)
+    assert mongo.crawl_state.checkpoint.count_documents({}) == 0
+
+
+def test_post_checkpoint_stays_at_the_last_written_page(mongo, fixtures, server, monkeypatch):
+    # one write per page, the second one fails
+    monkeypatch.setattr(crawler_module, 'BufferedMongoSink', functools.partial(BufferedMongoSink, batch_size=1))
+    bulk_upsert = mongodb.MongoAPI.bulk_upsert
+    writes = []
+
+    def fail_second_page(self, li_dict):
+        if li_dict and self.db_name == 'post_info':
+            writes.append(len(li_dict))
+            if len(writes) == 2:
+                raise RuntimeError('mongo blip')
+        return bulk_upsert(self, li_dict)
+
+    monkeypatch.setattr(mongodb.MongoAPI, 'bulk_upsert', fail_second_page)
+    with pytest.raises(SinkError):
+        post_crawler(server).crawl_post_info(1, 3)
+    assert CrawlCheckpoint(f'post_{BENCH_SYMBOL}_1_3').load()['page'] == 1
+
+    post_crawler(server).crawl_post_info(1, 3)  # picks up at page 2
+    stored = mongo.post_info[f'post_{BENCH_SYMBOL}']
+    assert sorted(post['_id'] for post in stored.find()) == listed(fixtures, 1, 2, 3)[:-1]  # without the pinned row
+    assert len(writes) == 4
+
+
+def test_comment_crawl_resumes_after_the_saved_post_id(mongo, fixtures, server):
+    benchmark = Benchmark(fixtures)
+    benchmark.server = server
+    ids = sorted(post['_id'] for post in benchmark.seed_posts(5))
+    CrawlCheckpoint(f'comment_{BENCH_SYMBOL}_id_{ids[0]}_{ids[-1]}').save(post_id=ids[1])
+    crawler = CommentCrawler(BENCH_SYMBOL, backend='api', reply_api_url=server.reply_api_url,
+                             limiter=unthrottled_limiter())
+    crawler.find_by_id(ids[0], ids[-1])
+    crawler.crawl_comment_info()
+    stored = mongo.comment_info[f'comment_{BENCH_SYMBOL}']
+    assert sorted(stored.distinct('post_id')) == ids[2:]
+    assert mongo.crawl_state.checkpoint.count_documents({}) == 0
+
+
+def test_incremental_high_water_starts_at_the_newest_stored_post(mongo, server):
+    post_crawler(server).crawl_post_info(1, 3)
+    newest = mongo.post_info[f'post_{BENCH_SYMBOL}'].find_one(sort=[('_id', -1)])['_id']
+    post_crawler(server).crawl_incremental(max_pages=1)
+    state = CrawlCheckpoint(f'incremental_{BENCH_SYMBOL}').load()
+    assert state['post_id'] == newest and state['post_url'].endswith(f',{newest}.html')
@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark import BENCH_SYMBOL, Benchmark, unthrottled_limiter
+from checkpoint import CrawlCheckpoint
+from crawler import PostCrawler, CommentCrawler, PostParser, CommentParser, PostYearResolver
+from reply_api import REPLY_PAGE_SIZE
+
+
+def test_post_parser(fixtures):
+    resolver = PostYearResolver()
+    newest = fixtures.post_ids(1)[0]
+    resolver.add_anchor(newest, str(fixtures.post_date(newest)))
+    posts = PostParser(resolver).parse_post_page(fixtures.list_page(3), 'http://guba', skip_first=False)
+    assert [post['_id'] for post in posts] == fixtures.post_ids(3)
+    assert [post['post_date'] for post in posts] == [str(fixtures.post_date(post_id)) for post_id in fixtures.post_ids(3)]
+    assert posts[0]['comment_num'] == fixtures.comment_num()
+    assert posts[0]['post_url'] == f'http://guba{fixtures.post_url(posts[0]["_id"])}'
+
+
+def test_comment_parsers(fixtures):
+    parser = CommentParser()
+    post_id = fixtures.post_ids(1)[0]
+    comments = parser.parse_comment_page(fixtures.post_page(post_id), post_id)
+    assert len(comments) == fixtures.comment_num()
+    assert sum(comment['sub_comment'] for comment in comments) == fixtures.replies * fixtures.sub_replies
+    assert len({comment['_id'] for comment in comments}) == len(comments)
+
+    replies = parser.parse_reply_data(fixtures.reply_data(post_id, 2), post_id)
+    assert len(replies) == (fixtures.replies - 30) * (1 + fixtures.sub_replies)
+    assert replies[0]['comment_content'].startswith(f'评论 {post_id} 第 30 楼')
+
+
+def test_identical_replies_on_different_reply_pages(monkeypatch):
+    # a thread of '顶' all posted in the same minute, three reply pages of them
+    page = {'re': [{'reply_text': '顶', 'reply_publish_time': '2024-07-01 09:30:00'}] * REPLY_PAGE_SIZE,
+            'count': 3 * REPLY_PAGE_SIZE, 'rc': 1}
+    monkeypatch.setattr(CommentCrawler, 'fetch_reply_page', lambda self, post_id, number, url: page)
+    rows = []
+    sink = type('Sink', (), {'put_many': lambda self, dic_list: rows.extend(dic_list)})()
+    crawler = CommentCrawler(BENCH_SYMBOL, backend='api')
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        assert crawler.stream_api_comments(CommentParser(), sink, 'url', 1, pool) == (3 * REPLY_PAGE_SIZE, True)
+    assert len({row['_id'] for row in rows}) == 3 * REPLY_PAGE_SIZE
+    assert rows[0]['_id'] == CommentParser.comment_id(rows[0])
+
+
+def test_http_post_crawler(mongo, fixtures, server):
+    crawler = PostCrawler(BENCH_SYMBOL, backend='http', base_url=server.url, limiter=unthrottled_limiter())
+    crawler.crawl_post_info(1, fixtures.pages, resume=False)
+    stored = mongo.post_info[f'post_{BENCH_SYMBOL}']
+    listed = [post_id for page in range(1, fixtures.pages + 1) for post_id in fixtures.post_ids(page)]
+    assert sorted(post['_id'] for post in stored.find()) == sorted(listed[1:])  # the pinned first row is skipped
+    assert mongo.crawl_state.checkpoint.count_documents({}) == 0  # finished, nothing to resume
+
+
+def test_api_comment_crawler(mongo, fixtures, server):
+    benchmark = Benchmark(fixtures)
+    benchmark.server = server
+    seeded = benchmark.seed_posts(5)
+    crawler = CommentCrawler(BENCH_SYMBOL, backend='api', reply_api_url=server.reply_api_url,
+                             limiter=unthrottled_limiter())
+    crawler.find_by_id(seeded[-1]['_id'], seeded[0]['_id'], resume=False)
+    crawler.crawl_comment_info()
+    stored = mongo.comment_info[f'comment_{BENCH_SYMBOL}']
+    assert crawler.current_num == 5 and crawler.reply_pages == 10
+    assert stored.count_documents({}) == 5 * fixtures.comment_num()
+    assert crawler.incomplete == []
+
+
+def test_drop_collections(mongo):
+    CrawlCheckpoint(f'post_{BENCH_SYMBOL}_1_20').save(page=3)  # left by an interrupted benchmark
+    CrawlCheckpoint('post_000002_1_20').save(page=3)
+    Benchmark.drop_collections()
+    assert [state['_id'] for state in mongo.crawl_state.checkpoint.find()] == ['post_000002_1_20']
+
+
+def test_concurrent_browser_crawl_is_labelled_http(mongo, fixtures, server):
+    crawler = PostCrawler(BENCH_SYMBOL, backend='browser', base_url=server.url, limiter=unthrottled_limiter())
+    crawler.crawl_post_info(1, fixtures.pages, concurrency=2, resume=False)
+    assert crawler.labels['backend'] == 'http'
+    assert mongo.post_info[f'post_{BENCH_SYMBOL}'].count_documents({}) == fixtures.pages * fixtures.posts_per_page - 1
@@ -0,0 +1,65 @@
+from year_resolver import PostYearResolver
+
+
+def resolver(*anchors, max_id_gap: int = 1000):
+    resolver = PostYearResolver(max_id_gap=max_id_gap)
+    for post_id, date in anchors:
+        resolver.add_anchor(post_id, date)
+    return resolver
+
+
+def test_same_year_between_agreeing_anchors():
+    assert resolver((100, '2024-07-01'), (200, '2024-07-20')).infer(150, 7, 10) == 2024
+
+
+def test_new_year_after_a_lower_anchor():
+    # a newer post whose date went backwards is in the next year
+    years = resolver((100, '2024-12-30'))
+    assert years.infer(150, 12, 31) == 2024
+    assert years.infer(150, 1, 2) == 2025
+
+
+def test_new_year_before_an_upper_anchor():
+    # an older post whose date is later than the anchor's is in the previous year
+    years = resolver((200, '2025-01-03'))
+    assert years.infer(150, 1, 2) == 2025
+    assert years.infer(150, 12, 30) == 2024
+
+
+def test_rollover_between_two_anchors():
+    years = resolver((100, '2024-12-30'), (200, '2025-01-03'))
+    assert years.infer(150, 12, 31) == 2024
+    assert years.infer(160, 1, 1) == 2025
+
+
+def test_disagreeing_anchors_trust_the_nearer_one():
+    # 'MM-DD' alone is ambiguous here: 02-01 is after the upper anchor's date in 2024, but before the lower's
+    years = resolver((100, '2024-03-01'), (900, '2024-12-01'))
+    assert years.infer(150, 2, 1) == 2025  # 50 ids from the lower anchor
+    assert years.infer(850, 2, 1) == 2024  # 50 ids from the upper anchor
+
+
+def test_disagreeing_anchors_too_far_away():
+    years = resolver((100, '2024-03-01'), (5000, '2024-12-01'))
+    assert years.infer(2500, 2, 1) is None
+
+
+def test_max_id_gap():
+    years = resolver((100, '2024-07-01'))
+    assert years.infer(1100, 7, 2) == 2024
+    assert years.infer(1101, 7, 2) is None
+    assert years.infer(99, 6, 30) == 2024  # an upper anchor only is trusted within the same gap
+    assert resolver((2000, '2024-07-01')).infer(999, 6, 30) is None
+
+
+def test_no_anchor():
+    assert resolver().infer(150, 7, 1) is None
+    assert resolver((100, '2024-07-01')).infer(None, 7, 1) is None
+
+
+def test_resolved_posts_become_anchors():
+    years = resolver((100, '2024-12-30'))
+    assert years.resolve(150, 'http://guba/news,000002,150.html', 1, 2) == 2025
+    assert years.anchors[150] == (2025, 1, 2)
+    assert years.resolve(120, 'http://guba/news,000002,120.html', 1, 1, accurate=False) == 2025
+    assert 120 not in years.anchors
@@ -0,0 +1,135 @@
+from lxml import html as lxml_html
+from lxml.cssselect import CSSSelector
+from urllib.parse import urlparse
+from datetime import datetime
+import bisect
+import re
+import threading
+
+
+# where the full date is shown on a post page
+YEAR_SELECTORS = {
+    'guba': CSSSelector('div.newsauthor > div.author-info.cl > div.time'),  # 这是绝大部分的普通帖子
+    'caifuhao': CSSSelector('div.article.page-article > div.article-head > '
+                            'div.article-meta > span.txt'),  # 有些热榜帖子会占据第一位
+}
+
+# an anchor on one side only is trusted within this distance of post ids (far less than a year of guba posts)
+MAX_ID_GAP = 2000000
+
+
+class PostYearResolver(object):
+    # the list page only shows 'MM-DD'; the year comes from posts whose full date is known (anchors),
+    # as guba post ids increase with the post time. Only unresolvable posts open their own page.
+
+    def __init__(self, fetcher=None, browser_getter=None, max_id_gap: int = MAX_ID_GAP, seen=None):
+        """
+        :param fetcher: 复用的 HttpFetcher，None 时按需创建
+        :param browser_getter: 返回当前 webdriver（或 None）的函数，HTTP 失败时在新标签页中打开帖子；
+                               只在创建 resolver 的线程（即使用这个 webdriver 的爬虫线程）中使用
+        :param seen: SeenPosts，命中时返回已入库帖子的 'YYYY-MM-DD'，不必再打开帖子
+        """
+        self.fetcher = fetcher
+        self.browser_getter = browser_getter
+        self.seen = seen
+        self.max_id_gap = max_id_gap
+        self.cache = {}  # post_id -> year
+        self.anchor_ids = []  # sorted post ids whose date is accurate
+        self.anchors = {}  # post_id -> (year, month, day)
+        self.lock = threading.Lock()
+        self.fetch_count = 0
+        self.owner = threading.current_thread()  # the thread driving the webdriver of 'browser_getter'
+
+    def resolve(self, post_id, post_url, month: int, day: int, accurate: bool = True):
+        """
+        :param accurate: 问董秘等帖子显示的日期不准确，不作为推断其他帖子的锚点
+        """
+        with self.lock:
+            year = self.cache.get(post_id)
+            if year is None:
+                year = self.infer(post_id, month, day)
+        if year is None:
+            year = self.stored_year(post_id)
+        if year is None:
+            year = self.fetch_year(post_url)
+        with self.lock:
+            if post_id is not None:
+                self.cache[post_id] = year
+                if accurate and post_id not in self.anchors:
+                    bisect.insort(self.anchor_ids, post_id)
+                    self.anchors[post_id] = (year, month, day)
+        return year
+
+    def add_anchor(self, post_id, date: str):
+        # e.g. posts already stored in mongo, 'YYYY-MM-DD'
+        year, month, day = map(int, date.split('-'))
+        with self.lock:
+            if post_id not in self.anchors:
+                bisect.insort(self.anchor_ids, post_id)
+                self.anchors[post_id] = (year, month, day)
+            self.cache[post_id] = year
+
+    def infer(self, post_id, month, day):
+        if post_id is None or not self.anchor_ids:
+            return None
+        index = bisect.bisect_left(self.anchor_ids, post_id)
+        candidates = []
+        if index > 0:  # an older post: the same year, or the next one if the date went backwards
+            lower_id = self.anchor_ids[index - 1]
+            year, lower_month, lower_day = self.anchors[lower_id]
+            candidates.append((post_id - lower_id, year if (month, day) >= (lower_month, lower_day) else year + 1))
+        if index < len(self.anchor_ids):  # a newer post: the same year, or the previous one
+            upper_id = self.anchor_ids[index]
+            year, upper_month, upper_day = self.anchors[upper_id]
+            candidates.append((upper_id - post_id, year if (month, day) <= (upper_month, upper_day) else year - 1))
+
+        if len(candidates) == 2:  # between two anchors the answer is exact when both sides agree
+            if candidates[0][1] == candidates[1][1]:
+                return candidates[0][1]
+        gap, year = min(candidates)
+        return year if gap <= self.max_id_gap else None
+
+    def stored_year(self, post_id):
+        # a post crawled by an earlier run already has its full date in mongo
+        date = self.seen.seen(post_id) if self.seen is not None else None
+        return int(date[:4]) if isinstance(date, str) else None
+
+    def fetch_year(self, post_url):
+        parsed = urlparse(post_url)
+        if parsed.netloc == 'caifuhao.eastmoney.com':
+            selector = YEAR_SELECTORS['caifuhao']
+        elif parsed.path.startswith('/news'):  # guba.eastmoney.com (or a server of recorded guba pages)
+            selector = YEAR_SELECTORS['guba']
+        else:
+            return datetime.now().year
+
+        with self.lock:
+            self.fetch_count += 1
+        try:
+            if self.fetcher is None:
+                from fetcher import HttpFetcher
+                self.fetcher = HttpFetcher()
+            page_source = self.fetcher.get(post_url)
+        except Exception:
+            # a selenium session is not thread-safe: a prefetch worker fails its page instead, the crawler
+            # then parses that page again on its own thread, where the browser can be used
+            if self.browser_getter is None or threading.current_thread() is not self.owner:
+                raise
+            browser = self.browser_getter()
+            if browser is None:
+                raise
+            page_source = self.browser_source(browser, post_url)
+        date_str = selector(lxml_html.fromstring(page_source))[0].text_content()
+        return int(re.sub(r'[^\d\s:-]', '', date_str).strip()[:4])  # 去掉日期中的“修改”等汉字
+
+    @staticmethod
+    def browser_source(browser, post_url):
+        # a new tab keeps the list page (and its elements) of the crawler intact
+        handle = browser.current_window_handle
+        browser.switch_to.new_window('tab')
+        try:
+            browser.get(post_url)
+            return browser.page_source
+        finally:
+            browser.close()
+            browser.switch_to.window(handle)